@@ -8,7 +8,10 @@ from spade.template import Template
 from spade.message import Message
 
 from common.base import BaseACLAgent
-from common.fipa import acl_msg, iso_in, new_conv_id, perf
+from common.fipa import (
+    acl_msg, inherit_md, iso_in, new_conv_id, perf,
+    PERF_REQUEST, PERF_AGREE, PERF_REFUSE, PERF_INFORM, PERF_FAILURE,
+)
 
 
 class CoordinatorAgent(BaseACLAgent):
@@ -21,10 +24,7 @@ class CoordinatorAgent(BaseACLAgent):
         async def run(self):
             # Daj innym agentom chwilę na rejestrację w Base (rejestr procesowy)
             # Czekamy aż pojawi się ktoś poza koordynatorem, max ~2s
-            for _ in range(8):
-                if len(self.agent.agents()) > 1:
-                    break
-                await asyncio.sleep(0.25)
+            await self.agent.wait_for_peers(timeout=2.0)
 
             # Wybór PROVIDERA po charakterze (persona); fallback: 'provider'
             prov_alias = self.agent.choose_agent_by_character(
@@ -42,8 +42,11 @@ class CoordinatorAgent(BaseACLAgent):
             conv = new_conv_id("order")
             tpl = Template(metadata={"conversation_id": conv})
 
+            # Metadane FIPA rozmowy liczone raz (wspólne dla AUDIT i wyniku)
+            base_md = inherit_md(None, conv)
+
             # Podłącz behawior ODBIERAJĄCY odpowiedzi ZANIM wyślesz REQUEST
-            waiter = self.agent.WaitReplies(conv, reporter_jid)
+            waiter = self.agent.WaitReplies(conv, reporter_jid, base_md)
             self.agent.add_behaviour(waiter, tpl)
 
             # Treść zamówienia: z ENV lub domyślna
@@ -54,72 +57,74 @@ class CoordinatorAgent(BaseACLAgent):
             # Wyślij REQUEST do wybranego Providera (FIPA metadane po staremu)
             req = acl_msg(
                 to=provider_jid,
-                performative="REQUEST",
+                performative=PERF_REQUEST,
                 content=order_text,
                 reply_by=reply_by_iso,
                 conv_id=conv,
             )
-            await self.send(req)
-
-            # AUDYT do wybranego Reportera
-            audit = Message(to=reporter_jid)
-            audit.body = f"AUDIT: wysłano REQUEST -> {provider_jid} ({conv})"
-            md = req.metadata or {}
-            audit.set_metadata("protocol", md.get("protocol", "fipa-request"))
-            audit.set_metadata("conversation_id", md.get("conversation_id", conv))
-            audit.set_metadata("ontology", md.get("ontology", "office.demo"))
-            audit.set_metadata("language", md.get("language", "text"))
-            audit.set_metadata("performative", "INFORM")
-            if "reply_by" in md:
-                audit.set_metadata("reply_by", md["reply_by"])
-            await self.send(audit)
+
+            # AUDYT do wybranego Reportera (wysyłany równolegle z REQUEST)
+            audit_md = {**base_md, "performative": PERF_INFORM}
+            if "reply_by" in req.metadata:
+                audit_md["reply_by"] = req.metadata["reply_by"]
+            audit = Message(
+                to=reporter_jid,
+                body=f"AUDIT: wysłano REQUEST -> {provider_jid} ({conv})",
+                metadata=audit_md,
+            )
+            await asyncio.gather(self.send(req), self.send(audit))
 
     class WaitReplies(CyclicBehaviour):
-        def __init__(self, conv_id: str, reporter_jid: str):
+        def __init__(self, conv_id: str, reporter_jid: str, base_md: dict | None = None):
             super().__init__()
             self.conv_id = conv_id
             self.reporter_jid = reporter_jid
+            # Szablon metadanych AUDIT-u końcowego (kopiowany per wiadomość)
+            self._fin_md = {**(base_md or inherit_md(None, conv_id)), "performative": PERF_INFORM}
             self.got_agree = False
-            self.deadline = asyncio.get_event_loop().time() + 30.0  # 30s na całą rozmowę
+            self.timeout_s = 30.0  # 30s na całą rozmowę
+            self.deadline = 0.0
+
+        async def on_start(self):
+            self._loop = asyncio.get_running_loop()
+            self.deadline = self._loop.time() + self.timeout_s
 
         async def run(self):
-            # Czekaj na dowolną wiadomość dopasowaną przez Template (conversation_id)
-            msg = await self.receive(timeout=15)
-            now = asyncio.get_event_loop().time()
+            # Czekaj na wiadomość (Template po conversation_id) dokładnie do deadline'u
+            remaining = self.deadline - self._loop.time()
+            if remaining <= 0:
+                logging.warning("[coordinator] timeout na odpowiedzi (%s)", self.conv_id)
+                self.kill()
+                return
 
+            msg = await self.receive(timeout=remaining)
             if not msg:
-                # Timeout częściowy – jeśli minął całkowity deadline, kończymy
-                if now >= self.deadline:
-                    logging.warning("[coordinator] timeout na odpowiedzi (%s)", self.conv_id)
-                    self.kill()
+                # następny cykl stwierdzi przekroczenie deadline'u
                 return
 
             p = perf(msg)
-            if p == "AGREE":
+            if p == PERF_AGREE:
                 self.got_agree = True
                 logging.info("[coordinator] Provider AGREE (%s)", self.conv_id)
                 return
 
-            if p == "REFUSE":
+            if p == PERF_REFUSE:
                 logging.info("[coordinator] Provider REFUSE (%s): %s", self.conv_id, msg.body or "")
                 self.kill()
                 return
 
-            if p in ("INFORM", "FAILURE"):
-                if p == "FAILURE":
+            if p in (PERF_INFORM, PERF_FAILURE):
+                if p == PERF_FAILURE:
                     logging.error("[coordinator] FAILURE (%s): %s", self.conv_id, msg.body or "")
                 else:
                     logging.info("[coordinator] INFORM (%s): %s", self.conv_id, msg.body or "")
 
                 # AUDYT końcowy do Reportera
-                fin = Message(to=self.reporter_jid)
-                fin.body = f"AUDIT: wynik zamówienia ({self.conv_id}): {msg.body or ''}"
-                md2 = msg.metadata or {}
-                fin.set_metadata("protocol", md2.get("protocol", "fipa-request"))
-                fin.set_metadata("conversation_id", md2.get("conversation_id", self.conv_id))
-                fin.set_metadata("ontology", md2.get("ontology", "office.demo"))
-                fin.set_metadata("language", md2.get("language", "text"))
-                fin.set_metadata("performative", "INFORM")
+                fin = Message(
+                    to=self.reporter_jid,
+                    body=f"AUDIT: wynik zamówienia ({self.conv_id}): {msg.body or ''}",
+                    metadata=dict(self._fin_md),
+                )
                 await self.send(fin)
 
                 # Kończymy po otrzymaniu wyniku
@@ -7,7 +7,7 @@ import logging
 from spade.behaviour import OneShotBehaviour
 
 from common.base import BaseACLAgent
-from common.llm import suggest
+from common.llm import asuggest
 from common.fipa import build_message, new_conv_id, iso_in
 
 
@@ -19,18 +19,18 @@ class ExplorerAgent(BaseACLAgent):
 
     class BootstrapOnce(OneShotBehaviour):
         async def run(self):
-            # Poczekaj krótko, aż inni agenci zarejestrują się w rejestrze procesu
-            for _ in range(8):
-                if len(self.agent.agents()) > 1:
-                    break
-                await asyncio.sleep(0.25)
-
             # Treść od użytkownika (CLI) lub z ENV, klasyczny fallback
             try:
                 user_text = sys.argv[1]
             except IndexError:
                 user_text = os.getenv("EXPLORER_TEXT", "Zamów 6 kanapek, budżet 60.")
 
+            # asuggest() (nieblokujące HTTP) liczy się w tle, równolegle z czekaniem na rejestr
+            note_task = asyncio.create_task(asuggest(user_text))
+
+            # Poczekaj krótko, aż inni agenci zarejestrują się w rejestrze procesu
+            await self.agent.wait_for_peers(timeout=2.0)
+
             items = int(os.getenv("EXPLORER_ITEMS", "6"))
             budget = int(os.getenv("EXPLORER_BUDGET", "60"))
 
@@ -54,7 +54,7 @@ class ExplorerAgent(BaseACLAgent):
                     "type": "ORDER_REQUEST",
                     "items": items,
                     "budget": budget,
-                    "user_note": suggest(user_text),
+                    "user_note": await note_task,
                     "from": "explorer",
                 },
                 # ontology/protocol/language domyślne w build_message
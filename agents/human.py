@@ -1,17 +1,17 @@
 # agents/human.py
 import sys
 import os
-import json
 import asyncio
 import logging
+from collections import OrderedDict
 from typing import Optional
 
 from spade.behaviour import CyclicBehaviour, OneShotBehaviour
-from spade.template import Template
 from spade.message import Message
 
 from common.base import BaseACLAgent
 from common.acl import AclMessage
+from common.jsonutil import dumps as _dumps, loads as _loads
 from common.fipa import (
     build_message,
     acl_msg,
@@ -28,40 +28,110 @@ HELP_TEXT = """
   json <to> <PERF> <tekst...>       - wyślij JSON FIPA-ACL (to=alias albo JID)
   classic <to> <PERF> <tekst...>    - wyślij klasyczny SPADE+FIPA (to=alias albo JID)
   reply <CID> <PERF> <tekst...>     - odpowiedz ostatniemu nadawcy w wątku CID (JSON lub classic wg historii)
+  show <CID>                        - pokaż ostatnią wiadomość JSON w wątku CID (sformatowaną)
   quit                              - zakończ pętlę wejścia (agent nadal działa)
 """
 
+
+class _StdinLines:
+    """
+    Linie ze stdin czytane w pętli zdarzeń (loop.add_reader + os.read), bez wątku executora
+    per komenda i bez przełączania fd w tryb nieblokujący (stdout na tty dzieli ten sam opis pliku).
+    None z readline() = EOF. Gdy stdin nie da się obserwować (np. zwykły plik), open() zwraca None.
+    """
+    def __init__(self, loop: asyncio.AbstractEventLoop, fd: int):
+        self._loop, self._fd = loop, fd
+        self._buf = b""
+        self._lines: asyncio.Queue = asyncio.Queue()
+
+    @classmethod
+    def open(cls) -> Optional["_StdinLines"]:
+        loop = asyncio.get_running_loop()
+        try:
+            fd = sys.stdin.fileno()
+            reader = cls(loop, fd)
+            loop.add_reader(fd, reader._on_readable)
+        except (AttributeError, ValueError, OSError, NotImplementedError):
+            return None
+        return reader
+
+    def _on_readable(self) -> None:
+        try:
+            data = os.read(self._fd, 65536)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            data = b""
+        if not data:
+            self._loop.remove_reader(self._fd)
+            if self._buf:
+                self._lines.put_nowait(self._buf.decode("utf-8", "replace"))
+                self._buf = b""
+            self._lines.put_nowait(None)
+            return
+        self._buf += data
+        *complete, self._buf = self._buf.split(b"\n")
+        for raw in complete:
+            self._lines.put_nowait(raw.decode("utf-8", "replace") + "\n")
+
+    async def readline(self) -> Optional[str]:
+        return await self._lines.get()
+
+    def close(self) -> None:
+        try:
+            self._loop.remove_reader(self._fd)
+        except Exception:
+            pass
+
 class HumanAgent(BaseACLAgent):
     def __init__(self, jid: str, password: str):
         super().__init__(jid, password)
         # tryb per CID: "json" | "classic"
-        self._last_mode_by_cid = {}
+        self._last_mode_by_cid = OrderedDict()
+        # ostatnie surowe body JSON per CID i jego sformatowana postać (liczona leniwie)
+        self._last_raw_by_cid = OrderedDict()
+        self._last_pretty_by_cid = OrderedDict()
+        # HUMAN_QUIET=1: tylko nagłówek wiadomości, treść na żądanie (show <CID>)
+        self._quiet = os.getenv("HUMAN_QUIET", "0").strip().lower() in {"1", "true", "yes", "on"}
 
     async def setup(self):
         await super().setup()
-        # Most klasyczny: odbiór nie-JSON (żeby nie ginęły stare komunikaty)
-        self.add_behaviour(self.ClassicInbox(), Template(metadata={"language": "text"}))
+        # Most klasyczny (nie-JSON) obsługuje wspólny InboxBehaviour → handle_classic()
         # Pętla wejścia z klawiatury (interaktywna obsługa)
         self.add_behaviour(self.ConsoleLoop())
 
     # ========== ODBIÓR NOWY: JSON FIPA-ACL ==========
     async def handle_acl(self, acl: AclMessage, sender: str):
         cid = acl.conversation_id or "(brak-cid)"
-        self._last_mode_by_cid[cid] = "json"
+        self._touch_cid(self._last_mode_by_cid, cid, "json")
+        self._touch_cid(self._last_raw_by_cid, cid, acl._raw or acl.model_dump_json())
+        self._last_pretty_by_cid.pop(cid, None)
 
-        pretty = json.dumps(acl.model_dump(), ensure_ascii=False, indent=2)
-        print(f"\n[human] << JSON from={sender} cid={cid} perf={acl.performative}\n{pretty}\n")
+        if self._quiet:
+            print(f"\n[human] << JSON from={sender} cid={cid} perf={acl.performative} (show {cid})\n")
+            return
+        print(f"\n[human] << JSON from={sender} cid={cid} perf={acl.performative}\n{self._pretty_for(cid)}\n")
+
+    def _pretty_for(self, cid: str) -> Optional[str]:
+        """Sformatowany JSON ostatniej wiadomości w CID (liczony raz, potem z cache)."""
+        pretty = self._last_pretty_by_cid.get(cid)
+        if pretty is None:
+            raw = self._last_raw_by_cid.get(cid)
+            if raw is None:
+                return None
+            try:
+                pretty = _dumps(_loads(raw), indent=True)
+            except Exception:
+                pretty = raw
+            self._touch_cid(self._last_pretty_by_cid, cid, pretty)
+        return pretty
 
     # ========== ODBIÓR STARY: SPADE+FIPA ==========
-    class ClassicInbox(CyclicBehaviour):
-        async def run(self):
-            msg = await self.receive(timeout=1)
-            if not msg:
-                return
-            # Niech Base nie próbuje parsować tego jako JSON
-            cid = (msg.metadata or {}).get("conversation_id") or (msg.metadata or {}).get("conversation-id") or "(brak-cid)"
-            self.agent._last_mode_by_cid[cid] = "classic"
-            print(f"\n[human] << CLASSIC from={msg.sender} cid={cid} perf={(msg.metadata or {}).get('performative','')}\n{msg.body}\n")
+    async def handle_classic(self, msg):
+        md = msg.metadata or {}
+        cid = md.get("conversation_id") or md.get("conversation-id") or "(brak-cid)"
+        self._touch_cid(self._last_mode_by_cid, cid, "classic")
+        print(f"\n[human] << CLASSIC from={msg.sender} cid={cid} perf={md.get('performative','')}\n{msg.body}\n")
 
     # ========== WYSYŁKA POMOCNICZA ==========
     async def _send_json(self, to_alias_or_jid: str, performative: str, text: str, cid: Optional[str] = None):
@@ -74,7 +144,7 @@ class HumanAgent(BaseACLAgent):
             payload={"text": text, "from": "human"},
         )
         await self.send_acl(to_jid, msg)
-        self._last_mode_by_cid[cid] = "json"
+        self._touch_cid(self._last_mode_by_cid, cid, "json")
         print(f"[human] >> JSON to={to_jid} cid={cid} perf={performative.upper()}  text={text}")
         return cid
 
@@ -89,7 +159,7 @@ class HumanAgent(BaseACLAgent):
             reply_by=iso_in(20),
         )
         await self.send(msg)
-        self._last_mode_by_cid[cid] = "classic"
+        self._touch_cid(self._last_mode_by_cid, cid, "classic")
         print(f"[human] >> CLASSIC to={to_jid} cid={cid} perf={performative.upper()}  text={text}")
         return cid
 
@@ -97,22 +167,29 @@ class HumanAgent(BaseACLAgent):
     class ConsoleLoop(CyclicBehaviour):
         async def on_start(self):
             # Delikatna pauza, żeby rejestr się zapełnił
-            for _ in range(8):
-                if len(self.agent.agents()) > 1:
-                    break
-                await asyncio.sleep(0.25)
+            await self.agent.wait_for_peers(timeout=2.0)
             print(HELP_TEXT.strip(), flush=True)
+            # stdin obserwowany przez pętlę zdarzeń; None → fallback na readline w executorze
+            self._stdin = _StdinLines.open()
+
+        async def on_end(self):
+            stdin = getattr(self, "_stdin", None)
+            if stdin is not None:
+                stdin.close()
 
         async def run(self):
-            loop = asyncio.get_running_loop()
             try:
-                line = await loop.run_in_executor(None, sys.stdin.readline)
+                if self._stdin is not None:
+                    line = await self._stdin.readline()
+                else:
+                    line = await asyncio.get_running_loop().run_in_executor(None, sys.stdin.readline)
             except Exception:
                 await asyncio.sleep(0.1)
                 return
 
             if not line:
-                await asyncio.sleep(0.1)
+                # EOF: wejście się skończyło — zakończ pętlę konsoli zamiast odpytywać co 0.1 s
+                self.kill()
                 return
 
             line = line.strip()
@@ -197,6 +274,19 @@ class HumanAgent(BaseACLAgent):
                     await self.agent._send_json(to, perf, text, cid=cid)
                 return
 
+            if cmd == "show":
+                # show <CID>  -> sformatowana ostatnia wiadomość JSON w wątku
+                if len(parts) < 2:
+                    print("[human] użycie: show <CID>")
+                    return
+                cid = parts[1]
+                pretty = self.agent._pretty_for(cid)
+                if pretty is None:
+                    print(f"[human] brak wiadomości JSON dla CID={cid}")
+                    return
+                print(pretty)
+                return
+
             if cmd == "quit":
                 print("[human] zakończono pętlę wejścia (agent nadal aktywny).")
                 self.kill()
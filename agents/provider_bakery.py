@@ -8,7 +8,70 @@ from spade.behaviour import CyclicBehaviour
 from spade.template import Template
 
 from common.base import BaseACLAgent
-from common.fipa import is_fipa_request, perf, conv_id
+from common.fipa import (
+    is_fipa_request, perf, conv_id, inherit_md,
+    ACL_PROTOCOL_REQUEST,
+    PERF_REQUEST, PERF_AGREE, PERF_REFUSE, PERF_INFORM,
+)
+
+# Ilość w treści zamówienia: pierwsza liczba
+_QTY_RE = re.compile(r"(\d+)")
+
+# Stałe treści odpowiedzi (budowane raz, nie per REQUEST)
+_REFUSE_BODY = "nie obsługuję tego zapytania"
+_INFORM_FMT = "zamówienie zrealizowane: {} {} świeżych".format
+
+
+class FipaResponder(CyclicBehaviour):
+    async def run(self):
+        msg = await self.receive(timeout=5)
+        if not msg:
+            return
+        if not is_fipa_request(msg) or perf(msg) != PERF_REQUEST:
+            return
+
+        agent = self.agent
+        item_keyword = agent.item_keyword
+        md = msg.metadata or {}
+        cid = conv_id(msg)
+        body = msg.body or ""
+        logging.info("[provider] REQUEST (%s) od %s: %s", cid, msg.sender, body)
+
+        # Metadane odpowiedzi liczone raz na REQUEST (bez performative) i współdzielone
+        # przez jego odpowiedzi AGREE/INFORM/REFUSE — nie między kolejnymi REQUEST w tej samej rozmowie
+        md_cache = {**md, **inherit_md(md, cid)}
+
+        # Proste kryterium: obsługujemy tylko jeśli treść dotyczy naszego asortymentu
+        if item_keyword not in body:
+            refuse = self._make_reply(msg, PERF_REFUSE, md_cache, _REFUSE_BODY)
+            await self.send(refuse)
+            return
+
+        # AGREE — wysyłka w tle, równolegle z „realizacją”
+        agree = self._make_reply(msg, PERF_AGREE, md_cache)
+        agree_task = asyncio.create_task(self.send(agree))
+
+        # „Realizacja” – opóźnienie kontrolowane ENV (powtarzalne demo)
+        await asyncio.sleep(agent.delay)
+
+        # Wyciągnij ilość z tekstu (pierwsza liczba), fallback: default_qty
+        m = _QTY_RE.search(body)
+        qty = int(m.group(1)) if m else agent.default_qty
+
+        # INFORM z wynikiem
+        inform = self._make_reply(msg, PERF_INFORM, md_cache, _INFORM_FMT(qty, item_keyword))
+        # AGREE musi wyjść przed INFORM (kolejność protokołu FIPA-Request)
+        await agree_task
+        await self.send(inform)
+
+    @staticmethod
+    def _make_reply(msg, performative: str, md_cache: dict, body: str | None = None):
+        """Odpowiedź na msg z gotowym kompletem metadanych (nowy dict per wiadomość)."""
+        reply = msg.make_reply()
+        reply.metadata = {**md_cache, "performative": performative}
+        if body is not None:
+            reply.body = body
+        return reply
 
 
 class ProviderAgent(BaseACLAgent):
@@ -27,55 +90,4 @@ class ProviderAgent(BaseACLAgent):
             self.delay = 0.5
 
         # Reaguj na FIPA-Request (stary styl: tekst w body + metadata)
-        self.add_behaviour(self.FipaResponder(), Template(metadata={"protocol": "fipa-request"}))
-
-    class FipaResponder(CyclicBehaviour):
-        async def run(self):
-            msg = await self.receive(timeout=5)
-            if not msg:
-                return
-            if not is_fipa_request(msg) or perf(msg) != "REQUEST":
-                return
-
-            md = msg.metadata or {}
-            cid = conv_id(msg)
-            body = msg.body or ""
-            logging.info("[provider] REQUEST (%s) od %s: %s", cid, str(msg.sender), body)
-
-            # Proste kryterium: obsługujemy tylko jeśli treść dotyczy naszego asortymentu
-            if self.agent.item_keyword not in body:
-                refuse = msg.make_reply()
-                refuse.set_metadata("performative", "REFUSE")
-                refuse.set_metadata("conversation_id", md.get("conversation_id", cid))
-                refuse.set_metadata("protocol", md.get("protocol", "fipa-request"))
-                refuse.set_metadata("ontology", md.get("ontology", "office.demo"))
-                refuse.set_metadata("language", md.get("language", "text"))
-                refuse.body = "nie obsługuję tego zapytania"
-                await self.send(refuse)
-                return
-
-            # AGREE
-            agree = msg.make_reply()
-            agree.set_metadata("performative", "AGREE")
-            agree.set_metadata("conversation_id", md.get("conversation_id", cid))
-            agree.set_metadata("protocol", md.get("protocol", "fipa-request"))
-            agree.set_metadata("ontology", md.get("ontology", "office.demo"))
-            agree.set_metadata("language", md.get("language", "text"))
-            await self.send(agree)
-
-            # „Realizacja” – opóźnienie kontrolowane ENV (powtarzalne demo)
-            await asyncio.sleep(self.agent.delay)
-
-            # Wyciągnij ilość z tekstu (pierwsza liczba), fallback: default_qty
-            m = re.search(r"(\d+)", body)
-            qty = int(m.group(1)) if m else self.agent.default_qty
-
-            # INFORM z wynikiem
-            inform = msg.make_reply()
-            inform.set_metadata("performative", "INFORM")
-            inform.set_metadata("conversation_id", md.get("conversation_id", cid))
-            inform.set_metadata("protocol", md.get("protocol", "fipa-request"))
-            inform.set_metadata("ontology", md.get("ontology", "office.demo"))
-            inform.set_metadata("language", md.get("language", "text"))
-            inform.body = f"zamówienie zrealizowane: {qty} {self.agent.item_keyword} świeżych"
-            await self.send(inform)
+        self.add_behaviour(FipaResponder(), Template(metadata={"protocol": ACL_PROTOCOL_REQUEST}))
@@ -1,33 +1,200 @@
 # agents/reporter.py
 import os
-import json
-import time
 import logging
 import asyncio
+import threading
+from collections import OrderedDict
+from typing import Any
 
 from spade.behaviour import CyclicBehaviour
 from spade.template import Template
 
 from common.base import BaseACLAgent
 from common.acl import AclMessage
-from common.fipa import conv_id, perf, protocol_of
+from common.fipa import conv_id, perf, protocol_of, now_s
+from common.jsonutil import dumps_bytes
 
 OUTDIR = "out"
 os.makedirs(OUTDIR, exist_ok=True)
 
 
+# Maks. liczba jednocześnie otwartych plików audytu (najdawniej używane są zamykane)
+MAX_OPEN_AUDIT_FILES = int(os.getenv("REPORTER_MAX_OPEN_FILES", "64"))
+
+
+def _audit_path(cid: str) -> str:
+    # jeden plik JSON-Lines na rozmowę; ts zostaje w rekordzie
+    return os.path.join(OUTDIR, f"audit-{cid}.jsonl")
+
+
+# Bufor roboczy per wątek executora: rekordy partii doklejane do jednego bytearray
+# (bez pośredniej listy fragmentów i nowego obiektu bytes z join dla każdej rozmowy).
+_SCRATCH = threading.local()
+
+
+def _flush(fhs: "OrderedDict[str, Any]", groups: dict) -> list:
+    """
+    Zapis partii rekordów do długo żyjących uchwytów (per conversation_id),
+    flush raz na partię. Wołane w wątku executora.
+    Każda rozmowa osobno: błąd jednej (np. CID niedozwolony w nazwie pliku) nie przepada
+    reszty partii. Zwraca listę CID zapisanych poprawnie.
+    """
+    buf = getattr(_SCRATCH, "buf", None)
+    if buf is None:
+        buf = _SCRATCH.buf = bytearray()
+    written = []
+    for cid, recs in groups.items():
+        try:
+            fh = fhs.get(cid)
+            if fh is None:
+                fh = open(_audit_path(cid), "ab", buffering=1 << 16)
+                fhs[cid] = fh
+                while len(fhs) > MAX_OPEN_AUDIT_FILES:
+                    _, old = fhs.popitem(last=False)
+                    old.close()
+            else:
+                fhs.move_to_end(cid)
+            buf.clear()
+            for r in recs:
+                buf += dumps_bytes(r, newline=True)
+            fh.write(buf)
+            fh.flush()
+            written.append(cid)
+        except Exception as e:
+            logging.error("[reporter] zapis audytu dla cid=%r nieudany (%d rekordów): %s", cid, len(recs), e)
+            bad = fhs.pop(cid, None)   # uszkodzony uchwyt nie wraca do puli
+            if bad is not None:
+                try:
+                    bad.close()
+                except Exception:
+                    pass
+    return written
+
+
+def _group(batch: list) -> dict:
+    groups: dict = {}
+    for rec in batch:
+        groups.setdefault(rec["conversation_id"], []).append(rec)
+    return groups
+
+
+def _flush_and_close(fhs: "OrderedDict[str, Any]", groups: dict) -> list:
+    """Ostatnia partia przy zatrzymaniu + zamknięcie uchwytów — w tym samym wątku executora."""
+    try:
+        return _flush(fhs, groups)
+    finally:
+        _close_all(fhs)
+
+
+def _close_all(fhs: "OrderedDict[str, Any]") -> None:
+    while fhs:
+        _, fh = fhs.popitem(last=False)
+        try:
+            fh.close()
+        except Exception:
+            pass
+
+
+class WriterBehaviour(CyclicBehaviour):
+    def match(self, message) -> bool:
+        # nie odbiera wiadomości XMPP — tylko kolejkę rekordów (bez zalegającej skrzynki)
+        return False
+
+    async def run(self):
+        agent = self.agent
+        q = agent._q
+        # rekordy przenoszone do agent._batch bez await po drodze: stop() zawsze je widzi,
+        # nawet jeśli ten behawior zostanie anulowany w oczekiwaniu na blokadę
+        agent._batch.append(await q.get())
+        while True:
+            try:
+                agent._batch.append(q.get_nowait())
+            except asyncio.QueueEmpty:
+                break
+        # jeden zapis naraz (także względem stop()) — _fhs zmienia tylko wątek trzymający blokadę
+        async with agent._flush_lock:
+            if agent._closed or not agent._batch:
+                return
+            batch, agent._batch = agent._batch, []
+            # wyjątek nie może wyjść z run(): SPADE zabiłby behawior, a kolejka przestałaby się opróżniać
+            try:
+                written = await asyncio.get_running_loop().run_in_executor(None, _flush, agent._fhs, _group(batch))
+            except Exception:
+                logging.exception("[reporter] zapis partii audytu nieudany (%d rekordów)", len(batch))
+                return
+        for cid in written:
+            logging.info("[reporter] zapisano audyt: %s", os.path.basename(_audit_path(cid)))
+
+
+class ClassicAuditSink(CyclicBehaviour):
+    async def run(self):
+        msg = await self.receive(timeout=10)
+        if not msg:
+            return
+        rec = {
+            "ts": now_s(),
+            "from": str(msg.sender),
+            "to": str(msg.to),
+            "performative": perf(msg),
+            "protocol": protocol_of(msg),
+            "conversation_id": conv_id(msg),
+            "body": msg.body,
+            "metadata": msg.metadata or {},   # tylko do serializacji — bez kopii
+        }
+        self.agent._enqueue(rec)
+
+
 class ReporterAgent(BaseACLAgent):
     async def setup(self):
         await super().setup()
-        # 1) JSON FIPA-ACL (wpada przez handle_acl)
-        self.add_behaviour(self.JsonAuditSink())  # „kotwica” pętli
+        # Kolejka rekordów audytu; zapis na dysk robi WriterBehaviour (partiami, poza pętlą)
+        self._q: asyncio.Queue = asyncio.Queue(maxsize=10_000)
+        self._fhs: "OrderedDict[str, Any]" = OrderedDict()   # CID -> otwarty plik audytu
+        self._batch: list = []                 # rekordy zdjęte z kolejki, jeszcze niezapisane
+        self._flush_lock = asyncio.Lock()      # WriterBehaviour vs stop(): jeden zapis naraz
+        self._closing = False                  # stop() w toku: nowe rekordy nie są przyjmowane
+        self._closed = False                   # uchwyty zamknięte, ostatnia partia zapisana
+        self.add_behaviour(WriterBehaviour())
+        # 1) JSON FIPA-ACL wpada przez handle_acl (InboxBehaviour z BaseACLAgent)
         # 2) Klasyczny tor (language=text), bez dublowania JSON
-        self.add_behaviour(self.ClassicAuditSink(), Template(metadata={"language": "text"}))
+        self.add_behaviour(ClassicAuditSink(), Template(metadata={"language": "text"}))
+
+    def _enqueue(self, rec: dict) -> None:
+        """Rekord do kolejki zapisu bez czekania: pełna kolejka → rekord odrzucony i zalogowany
+        (nie blokuje wspólnego InboxBehaviour)."""
+        if self._closing:
+            return
+        try:
+            self._q.put_nowait(rec)
+        except asyncio.QueueFull:
+            logging.warning("[reporter] kolejka audytu pełna — odrzucono rekord cid=%s", rec.get("conversation_id"))
+
+    async def stop(self):
+        """
+        Zatrzymanie bez utraty rekordów: wstrzymaj przyjmowanie, poczekaj na trwający zapis,
+        dopisz resztę kolejki jedną partią i zamknij uchwyty — w executorze, pod tą samą blokadą.
+        """
+        if hasattr(self, "_q") and not self._closed:
+            self._closing = True
+            async with self._flush_lock:
+                while True:
+                    try:
+                        self._batch.append(self._q.get_nowait())
+                    except asyncio.QueueEmpty:
+                        break
+                batch, self._batch = self._batch, []
+                try:
+                    await asyncio.get_running_loop().run_in_executor(
+                        None, _flush_and_close, self._fhs, _group(batch))
+                except Exception:
+                    logging.exception("[reporter] końcowy zapis audytu nieudany (%d rekordów)", len(batch))
+                self._closed = True
+        return await super().stop()
 
     # --- JSON: przychodzi przez BaseACLAgent.handle_acl -> tutaj zapis ---
     async def handle_acl(self, acl: AclMessage, sender: str):
         rec = {
-            "ts": int(time.time()),
+            "ts": now_s(),
             "from": sender,
             "to": str(self.jid),
             "performative": acl.performative,
@@ -40,32 +207,4 @@ class ReporterAgent(BaseACLAgent):
                 "reply_by": acl.reply_by,
             },
         }
-        path = os.path.join(OUTDIR, f"audit-{rec['ts']}-{rec['conversation_id']}.json")
-        with open(path, "a", encoding="utf-8") as f:
-            f.write(json.dumps(rec, ensure_ascii=False) + "\n")
-        logging.info("[reporter] zapisano audyt: %s", os.path.basename(path))
-
-    class JsonAuditSink(CyclicBehaviour):
-        async def run(self):
-            # nic nie odbiera – tylko pozwala mieć cykl
-            await asyncio.sleep(0.1)
-
-    class ClassicAuditSink(CyclicBehaviour):
-        async def run(self):
-            msg = await self.receive(timeout=10)
-            if not msg:
-                return
-            rec = {
-                "ts": int(time.time()),
-                "from": str(msg.sender),
-                "to": str(msg.to),
-                "performative": perf(msg),
-                "protocol": protocol_of(msg),
-                "conversation_id": conv_id(msg),
-                "body": msg.body,
-                "metadata": dict(msg.metadata or {}),
-            }
-            path = os.path.join(OUTDIR, f"audit-{rec['ts']}-{rec['conversation_id']}.json")
-            with open(path, "a", encoding="utf-8") as f:
-                f.write(json.dumps(rec, ensure_ascii=False) + "\n")
-            logging.info("[reporter] zapisano audyt: %s", os.path.basename(path))
+        self._enqueue(rec)
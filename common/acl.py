@@ -1,21 +1,38 @@
 import logging
-import json
 try:
     from common.audit import log_acl
 except Exception:
     def log_acl(*args, **kwargs):
         pass
 # common/acl.py
-from typing import Dict, Any, Optional
-import json
+from typing import Annotated, Dict, Any, Optional
 
-from pydantic import BaseModel, Field, field_validator
+from pydantic import BaseModel, BeforeValidator, Field, PrivateAttr
+
+from common.jsonutil import dumps as _dumps, loads as _loads
 from spade.message import Message
 
 logger = logging.getLogger("common.acl")
-PERFORMATIVES = {"REQUEST", "AGREE", "REFUSE", "INFORM", "FAILURE", "CANCEL"}
-
-ALLOWED_PERFORMATIVES = PERFORMATIVES 
+PERFORMATIVES: frozenset = frozenset({"REQUEST", "AGREE", "REFUSE", "INFORM", "FAILURE", "CANCEL"})
+
+ALLOWED_PERFORMATIVES = PERFORMATIVES   # niemutowalny: O(1) test przynależności, stała kolejność enum w schemacie (sorted)
+_DEFAULT_PROTOCOL = "fipa-request"
+_NO_MD: Dict[str, Any] = {}   # zastępuje brak metadanych (nie modyfikować)
+
+# Kanoniczna postać performatywu dla najczęstszych zapisów (bez upper()/strip() per wiadomość)
+_PERF_CANON: Dict[str, str] = {p: p for p in ALLOWED_PERFORMATIVES}
+_PERF_CANON.update({p.lower(): p for p in ALLOWED_PERFORMATIVES})
+
+def _norm_perf(v: Any) -> str:
+    if isinstance(v, str):
+        canon = _PERF_CANON.get(v)
+        if canon is not None:
+            return canon
+        v_up = v.upper().strip()   # inne zapisy: "Inform", " agree "
+        if v_up in ALLOWED_PERFORMATIVES:
+            return v_up
+    logger.error("unsupported performative %r", v)
+    raise ValueError(f"unsupported performative '{v}'")
 
 class AclMessage(BaseModel):
     """
@@ -24,63 +41,50 @@ class AclMessage(BaseModel):
     - ładunek aplikacyjny: payload (dict)
     - nadawca/odbiorca: sender/receiver (opcjonalne, ale uzupełniane przy transporcie)
     """
-    performative: str
-    conversation_id: str
-    protocol: str = "fipa-request"
+    performative: Annotated[str, BeforeValidator(_norm_perf)]
+    # niepusty i nie same białe znaki — sprawdzane w pydantic-core (bez walidatora w Pythonie)
+    conversation_id: str = Field(pattern=r"\S")
+    protocol: str = _DEFAULT_PROTOCOL
     ontology: str = "office.demo"
     language: str = "json"
     reply_by: Optional[str] = None        # ISO8601 UTC, opcjonalnie
     sender: Optional[str] = None          # <— DODANE
     receiver: Optional[str] = None        # <— DODANE
     payload: Dict[str, Any] = Field(default_factory=dict)
+    # Surowe body JSON, z którego odtworzono wiadomość (tylko from_spade; poza model_dump)
+    _raw: Optional[str] = PrivateAttr(default=None)
     
-    # --- Normalizacja / walidacja pól ---
-    @field_validator("performative")
-    @classmethod
-    def _perf_upper_and_allowed(cls, v: str) -> str:
-        v_up = (v or "").upper().strip()
-        if v_up not in ALLOWED_PERFORMATIVES:
-            logger.error("unsupported performative %r", v)
-            raise ValueError(f"unsupported performative '{v}'")
-        return v_up
-
-    @field_validator("conversation_id")
-    @classmethod
-    def _conv_required(cls, v: str) -> str:
-        if not v or not v.strip():
-            raise ValueError("conversation_id is required")
-        return v
-
     # --- Transport SPADE <-> model ---
-    def to_spade(self, to_jid: str, sender_jid) -> Message:
+    def to_spade(self, to_jid: str, sender_jid, raw: Optional[str] = None) -> Message:
         """
         Zamień AclMessage na SPADE Message z JSON w body i metadanymi FIPA.
         W body gwarantujemy obecność sender/receiver (nie mutujemy self).
+        raw — gotowe body JSON (np. przy wysyłce tej samej wiadomości do wielu adresatów).
         """
-        body: Dict[str, Any] = self.model_dump()
-        body.setdefault("sender", str(sender_jid))
-        body.setdefault("receiver", str(to_jid))
+        # model_dump() zawsze zawiera klucze sender/receiver, więc body = model;
+        # serializacja po stronie pydantic-core (bez pośredniego dict + json.dumps)
+        if raw is None:
+            raw = self.model_dump_json()
 
-        msg = Message(to=str(to_jid))
-        msg.body = json.dumps(body, ensure_ascii=False)
+        # SPADE wymaga czystego stringa w to/sender
+        msg = Message(to=str(to_jid), sender=str(sender_jid), body=raw)
 
-        # SPADE wymaga czystego stringa:
-        msg.sender = str(sender_jid)
-
-        proto = getattr(self, "protocol", None) or "fipa-request"
-        rb = getattr(self, "reply_by", None)
+        # pola modelu są zawsze obecne (walidacja pydantic) — bez getattr/domyślnych
         md = {
             "performative": self.performative,
-            "protocol": proto,
+            "protocol": self.protocol or _DEFAULT_PROTOCOL,
             "conversation_id": self.conversation_id,
             "ontology": self.ontology,
             "language": self.language,
         }
-        if rb:
-            md["reply_by"] = rb
+        if self.reply_by:
+            md["reply_by"] = self.reply_by
         msg.metadata = md
+        if not logger.isEnabledFor(logging.INFO):
+            return msg
         try:
-            logger.info(json.dumps({"kind":"ACL_TO_SPADE","acl": body, "metadata": md}, ensure_ascii=False))
+            logger.info('{"kind": "ACL_TO_SPADE", "acl": %s, "metadata": %s}',
+                        raw, _dumps(md))
         except Exception:
             pass
         return msg
@@ -93,7 +97,7 @@ class AclMessage(BaseModel):
         2) Fallback: metadane + surowe body w payload["text"].
         Zawsze zwraca obiekt albo rzuca wyjątek — nigdy po cichu None.
         """
-        md   = msg.metadata or {}
+        md   = msg.metadata or _NO_MD   # tylko odczyt — bez kopii metadanych
         conv = md.get("conversation_id") or md.get("conversation-id")
         perf = (md.get("performative") or "").upper()
         proto= md.get("protocol") or "fipa-request"
@@ -103,10 +107,14 @@ class AclMessage(BaseModel):
         snd  = str(msg.sender) if msg.sender else None
         rcv  = str(getattr(msg, "to", None)) if getattr(msg, "to", None) else None
 
-        # 1) BODY JAKO JSON
-        if msg.body:
+        # 1) BODY JAKO JSON — tylko gdy body wygląda na obiekt (bez wyjątków dla tekstu)
+        body = msg.body or ""
+        head = body[:1]
+        if head.isspace():
+            head = body.lstrip()[:1]
+        if head == "{":
             try:
-                obj = json.loads(msg.body)
+                obj = _loads(body)   # orjson (fallback: json); błędy dekodowania to ValueError
                 if not isinstance(obj, dict):
                     raise ValueError("body JSON is not an object")
 
@@ -122,7 +130,9 @@ class AclMessage(BaseModel):
                 if "payload" not in obj or not isinstance(obj["payload"], dict):
                     obj["payload"] = {}
 
-                out = cls.model_validate(obj)  # ← WAŻNE: poza if-em dot. payload
+                # ← WAŻNE: poza if-em dot. payload; podklasy mają własny walidator
+                out = cls.__pydantic_validator__.validate_python(obj)
+                out._raw = msg.body
 
                 try:
                     log_acl("SPADE_IN", out, agent=None, peer=str(msg.sender),
@@ -130,7 +140,7 @@ class AclMessage(BaseModel):
                 except Exception:
                     pass
                 return out
-            except Exception as e:
+            except ValueError as e:  # też pydantic.ValidationError
                 logger.error("from_spade: invalid/unsupported JSON body: %s", e)
 
         # 2) FALLBACK: metadane + surowe body jako tekst
@@ -155,3 +165,8 @@ class AclMessage(BaseModel):
         except Exception:
             pass
         return out
+
+
+# Walidator/serializer pydantic-core modelu — bez warstwy model_validate()/model_dump() w Pythonie
+ACL_VALIDATOR = AclMessage.__pydantic_validator__
+ACL_SERIALIZER = AclMessage.__pydantic_serializer__
@@ -1,10 +1,13 @@
 
 # common/audit.py
 from __future__ import annotations
-import os, json, time, logging
+import os, re, time, logging, queue, atexit, threading
+from logging.handlers import QueueHandler, QueueListener
 from pathlib import Path
 from typing import Any, Dict, Optional
 
+from common.jsonutil import dumps as _dumps, dumps_bytes as _dumps_bytes
+
 # --- Logger ---
 logger = logging.getLogger("common.audit")
 
@@ -21,16 +24,14 @@ def _ts() -> int:
     return int(time.time())
 
 # --- Helpers ---
-_REDACT_KEYS = {"authorization", "api_key", "apikey", "token", "password", "secret", "bearer"}
+_REDACT_RE = re.compile(r"(?i)^(?:authorization|api_?key|token|password|secret|bearer)$")
 
 def _redact(obj: Any) -> Any:
-    try:
-        if isinstance(obj, dict):
-            return {k: ("***" if k.lower() in _REDACT_KEYS else _redact(v)) for k, v in obj.items()}
-        if isinstance(obj, list):
-            return [_redact(v) for v in obj]
-    except Exception:
-        pass
+    t = type(obj)
+    if t is dict or isinstance(obj, dict):
+        return {k: ("***" if type(k) is str and _REDACT_RE.match(k) else _redact(v)) for k, v in obj.items()}
+    if t is list:
+        return [_redact(v) for v in obj]
     return obj
 
 def setup_logging(default_level: str = "INFO") -> None:
@@ -46,32 +47,139 @@ def setup_logging(default_level: str = "INFO") -> None:
         except Exception:
             level = logging.INFO
         root.setLevel(level)
+        # tylko dla własnego handlera — konfiguracji aplikacji nie przestawiamy
+        if os.getenv("LOG_QUEUE", "1").strip().lower() in {"1", "true", "yes", "on"}:
+            enable_queue_logging()
+
+_LISTENER: Optional[QueueListener] = None
+
+def enable_queue_logging() -> None:
+    """
+    Move the root handlers behind a QueueHandler: QueueHandler.prepare() still formats
+    the message on the calling thread, only the handlers' stream I/O runs on a
+    QueueListener thread. Idempotent.
+    """
+    global _LISTENER
+    if _LISTENER is not None:
+        return
+    root = logging.getLogger()
+    handlers = [h for h in root.handlers if not isinstance(h, QueueHandler)]
+    if not handlers:
+        return
+    q: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+    for h in handlers:
+        root.removeHandler(h)
+    root.addHandler(QueueHandler(q))
+    _LISTENER = QueueListener(q, *handlers, respect_handler_level=True)
+    _LISTENER.start()
+    atexit.register(_LISTENER.stop)  # drains remaining records on exit
+
+# --- Zapis plików audytu w tle ---
+# Wołający tylko serializuje i wrzuca (ścieżka, bajty) do kolejki; mkdir/zapis robi jeden wątek,
+# więc dysk nie leży na ścieżce obsługi wiadomości. Przepełnienie → rekord odrzucony (licznik).
+AUDIT_ASYNC = os.getenv("AUDIT_ASYNC", "1").strip().lower() in {"1", "true", "yes", "on"}
+_WRITE_Q: "queue.Queue[Optional[tuple[Path, bytes]]]" = queue.Queue(maxsize=int(os.getenv("AUDIT_QUEUE_MAX", "10000")))
+_WRITE_BATCH = 64
+_WRITER: Optional[threading.Thread] = None
+_WRITER_LOCK = threading.Lock()
+_STATS: Dict[str, int] = {"written": 0, "dropped": 0}
+
+def _write_file(path: Path, data: bytes) -> None:
+    try:
+        _safe_mkdir(path.parent)
+        path.write_bytes(data)
+        _STATS["written"] += 1
+    except Exception:
+        # Keep going even if disk is not writable
+        pass
+
+def _writer_loop() -> None:
+    while True:
+        item = _WRITE_Q.get()
+        batch = [item]
+        # dobierz, co już czeka (bez czekania), żeby obsłużyć serię jednym przebiegiem
+        while len(batch) < _WRITE_BATCH:
+            try:
+                batch.append(_WRITE_Q.get_nowait())
+            except queue.Empty:
+                break
+        for it in batch:
+            if it is None:
+                return
+            _write_file(*it)
+
+def _stop_writer() -> None:
+    if _WRITER is not None and _WRITER.is_alive():
+        _WRITE_Q.put(None)   # wartownik na końcu: zapisze wszystko, co przed nim
+        _WRITER.join(timeout=5)
+
+def _ensure_writer() -> None:
+    global _WRITER
+    if _WRITER is not None:
+        return
+    with _WRITER_LOCK:
+        if _WRITER is None:
+            t = threading.Thread(target=_writer_loop, name="audit-writer", daemon=True)
+            t.start()
+            _WRITER = t
+            atexit.register(_stop_writer)
+
+def _submit(path: Path, data: bytes) -> None:
+    if not AUDIT_ASYNC:
+        _write_file(path, data)
+        return
+    _ensure_writer()
+    try:
+        _WRITE_Q.put_nowait((path, data))
+    except queue.Full:
+        _STATS["dropped"] += 1
+
+def stats() -> Dict[str, int]:
+    """Liczniki zapisu audytu: zapisane pliki, odrzucone przy pełnej kolejce, oczekujące."""
+    return {**_STATS, "pending": _WRITE_Q.qsize()}
 
 # --- File save (backwards compatible) ---
 def save(agent_name: str, conversation_id: str, stage: str, payload: Dict[str, Any]) -> None:
     """
     Save a pretty JSON file with a stage of processing under out/ai_audit/<agent>.
-    Keeps existing behaviour; add structured log line too.
+    Keeps existing behaviour; add structured log line too. The file is written
+    by the background writer (AUDIT_ASYNC=0 writes inline).
     """
-    base = AUDIT_DIR / agent_name
-    _safe_mkdir(base)
-    fname = f"{_ts()}-{conversation_id}-{stage}.json"
-    path = base / fname
+    path = AUDIT_DIR / agent_name / f"{_ts()}-{conversation_id}-{stage}.json"
     try:
-        with open(path, "w", encoding="utf-8") as f:
-            json.dump(payload, f, ensure_ascii=False, indent=2)
+        _submit(path, _dumps_bytes(payload, indent=True))
     except Exception:
-        # Keep going even if disk is not writable
         pass
-    # structured log
+    _log_stage(agent_name, conversation_id, stage, payload)
+
+def save_many(agent_name: str, conversation_id: str, records: list[tuple[str, Dict[str, Any]]]) -> None:
+    """
+    Save several consecutive stages in one write: a JSON-Lines file
+    <ts>-<conversation_id>-stages.jsonl with one {"stage", "payload"} object per line.
+    Each stage still gets its own structured log line.
+    """
+    if not records:
+        return
+    path = AUDIT_DIR / agent_name / f"{_ts()}-{conversation_id}-stages.jsonl"
+    try:
+        _submit(path, b"".join(_dumps_bytes({"stage": st, "payload": pl}, newline=True) for st, pl in records))
+    except Exception:
+        pass
+    for stage, payload in records:
+        _log_stage(agent_name, conversation_id, stage, payload)
+
+def _log_stage(agent_name: str, conversation_id: str, stage: str, payload: Dict[str, Any]) -> None:
+    # structured log (serializacja tylko przy aktywnym INFO)
+    if not logger.isEnabledFor(logging.INFO):
+        return
     try:
-        logger.info(json.dumps({
+        logger.info(_dumps({
             "kind": "AUDIT_STAGE",
             "agent": agent_name,
             "conversation_id": conversation_id,
             "stage": stage,
             "payload": payload
-        }, ensure_ascii=False))
+        }))
     except Exception:
         pass
 
@@ -82,16 +190,17 @@ def log_acl(direction: str, acl_obj: Any, *, agent: Optional[str] = None, peer:
     Log any AclMessage (or dict-like) in full.
     direction: 'IN' | 'OUT' | 'PARSED' | 'SPADE_IN' | 'SPADE_OUT' (free-form allowed)
     """
+    if not logger.isEnabledFor(logging.INFO):
+        return
     try:
-        if hasattr(acl_obj, "model_dump_json"):
-            acl_json = json.loads(acl_obj.model_dump_json())
-        elif hasattr(acl_obj, "model_dump"):
-            acl_json = acl_obj.model_dump()
+        if hasattr(acl_obj, "model_dump"):
+            # od razu dict w trybie JSON (bez serializacji i ponownego parsowania)
+            acl_json = acl_obj.model_dump(mode="json")
         elif isinstance(acl_obj, dict):
             acl_json = acl_obj
         else:
             acl_json = {"_repr": str(acl_obj)}
-        logger.info(json.dumps({
+        logger.info(_dumps({
             "kind": "ACL_LOG",
             "direction": direction,
             "agent": agent,
@@ -99,15 +208,17 @@ def log_acl(direction: str, acl_obj: Any, *, agent: Optional[str] = None, peer:
             "transport": transport,
             "note": note,
             "acl": acl_json
-        }, ensure_ascii=False))
+        }))
     except Exception:
         pass
 
 # --- AI I/O logging ---
 def log_ai_request(agent: Optional[str], conversation_id: Optional[str], provider: str, model: str, body: Dict[str, Any],
                    *, endpoint: Optional[str] = None, headers: Optional[Dict[str, Any]] = None) -> None:
+    if not logger.isEnabledFor(logging.INFO):
+        return
     try:
-        logger.info(json.dumps({
+        logger.info(_dumps({
             "kind": "AI_REQUEST",
             "agent": agent,
             "conversation_id": conversation_id,
@@ -116,14 +227,16 @@ def log_ai_request(agent: Optional[str], conversation_id: Optional[str], provide
             "endpoint": endpoint,
             "headers": _redact(headers or {}),
             "body": body,
-        }, ensure_ascii=False))
+        }))
     except Exception:
         pass
 
 def log_ai_response(agent: Optional[str], conversation_id: Optional[str], provider: str, model: str,
                     status: int, data: Any) -> None:
+    if not logger.isEnabledFor(logging.INFO):
+        return
     try:
-        logger.info(json.dumps({
+        logger.info(_dumps({
             "kind": "AI_RESPONSE",
             "agent": agent,
             "conversation_id": conversation_id,
@@ -131,6 +244,6 @@ def log_ai_response(agent: Optional[str], conversation_id: Optional[str], provid
             "model": model,
             "status": status,
             "data": data,
-        }, ensure_ascii=False))
+        }))
     except Exception:
         pass
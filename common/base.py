@@ -7,20 +7,30 @@
 from __future__ import annotations
 
 import os
-import json
+import re
+import sys
 import time
+import string
+import functools
 import asyncio
 import logging
+from collections import OrderedDict
 try:
-    from common.audit import log_acl
+    from common.audit import log_acl, enable_queue_logging
 except Exception:
     def log_acl(*args, **kwargs):
         pass
-from typing import Dict, Any, Optional, List, Tuple
+    def enable_queue_logging() -> None:
+        pass
+from types import MappingProxyType
+from typing import Dict, Any, Mapping, Optional, List, Tuple
 
 LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
 if not logging.getLogger().handlers:
     logging.basicConfig(level=getattr(logging, LOG_LEVEL, logging.INFO), format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+    # zapis logów w osobnym wątku (LOG_QUEUE=0 wyłącza)
+    if os.getenv("LOG_QUEUE", "1").strip().lower() in {"1", "true", "yes", "on"}:
+        enable_queue_logging()
 logger = logging.getLogger('common.base')
 
 from spade.agent import Agent
@@ -28,7 +38,8 @@ from spade.behaviour import CyclicBehaviour, OneShotBehaviour
 from spade.template import Template
 
 from common.acl import AclMessage
-from common.fipa import make_reply
+from common.jsonutil import dumps as _dumps, dumps_bytes as _dumps_bytes, loads as _loads
+from common.fipa import make_reply, now_s
 
 # --- Opcjonalne moduły (nie wymagane do startu) ---
 try:
@@ -49,67 +60,138 @@ try:
 except Exception:
     pick_agent = None
 
+try:
+    # Zamknięcie współdzielonych klientów HTTP LLM przy wyłączaniu ostatniego agenta
+    from common.llm import aclose_clients  # async def aclose_clients() -> None
+except Exception:
+    aclose_clients = None
+
 # Ścieżka do pliku z migawką rejestru (podgląd z zewnątrz)
 _REG_PATH = os.getenv("AGENTS_REG_PATH", "out/agents_registry.json")
 
+@functools.lru_cache(maxsize=None)
+def _env_jid_for(alias: str) -> Optional[str]:
+    """JID_<ALIAS> z ENV (fallback resolve); ENV stałe w trakcie działania."""
+    return os.getenv(f"JID_{alias.upper()}")
+
+# Okno zbierania zmian rejestru przed zapisem pliku (sekundy)
+_REG_FLUSH_DELAY = float(os.getenv("AGENTS_REG_FLUSH_S", "0.1"))
+
+def _write_registry_file(data: bytes) -> None:
+    """Zapis atomowy: plik tymczasowy + os.replace (czytelnik nie zobaczy połówki)."""
+    os.makedirs(os.path.dirname(_REG_PATH) or ".", exist_ok=True)
+    tmp = f"{_REG_PATH}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())   # treść na dysku przed podmianą nazwy (bez pustego pliku po awarii)
+    os.replace(tmp, _REG_PATH)
+
+# Ontologia zapytań o rejestr (LIST/DISCOVER), internowana
+_ONT_REGISTRY = sys.intern("office.registry")
+
+# Zadania wysyłek w tle (call_later) — trzymane do zakończenia, by GC ich nie zebrał
+_BG_TASKS: "set[asyncio.Task]" = set()
+
+# Limit wpisów w mapach per-CID (ostatni nadawca, tryb…) — najstarsze wypadają (LRU)
+_MAX_CIDS = max(1, int(os.getenv("ACL_MAX_CIDS", "4096")))
+
+
+# Tokeny heurystyki routingu po charakterze
+_TOKEN_RE = re.compile(r"[a-z0-9]{3,}")
+
+def _text_tokens(s: str) -> frozenset:
+    return frozenset(_TOKEN_RE.findall(s.lower()))
+
+def _info_tokens(info: Mapping[str, Any]) -> frozenset:
+    """Tokeny persony wpisu rejestru: character + class."""
+    return _text_tokens(f"{info.get('character','')} {info.get('class','')}")
+
+_NO_MD: Dict[str, Any] = {}   # tylko do odczytu: zastępuje msg.metadata == None bez alokacji
 
 class InboxBehaviour(CyclicBehaviour):
     async def run(self):
-        msg = await self.receive(timeout=1)
+        msg = await self.receive(timeout=5)
         if not msg:
             return
 
-        # Parsuj tylko, jeśli to wygląda na JSON-ACL
-        md = dict(msg.metadata or {})
-        lang = (md.get("language") or "").lower()
-        body = (msg.body or "").lstrip()
+        # Parsuj tylko, jeśli to wygląda na JSON-ACL (tani test przed pełnym parsowaniem):
+        # najpierw pierwszy znak body, metadane language dopiero gdy body nie wygląda na JSON
+        body = msg.body or ""
+        looks_json = body.startswith(("{", "["))
+        if not looks_json and body[:1].isspace():
+            looks_json = next((c for c in body if not c.isspace()), "") in ("{", "[")
+        if not looks_json:
+            if ((msg.metadata or _NO_MD).get("language") or "").lower() != "json":
+                if body:
+                    # Nie-JSON: hook agenta; domyślnie nic — zostaw innym behawiorom
+                    # (np. klasycznym FIPA u providera/koordynatora)
+                    await self.agent.handle_classic(msg)
+                return
 
-        is_json_like = body.startswith("{") or body.startswith("[")
-        if not (lang == "json" or is_json_like):
-            # Nie-JSON: zostaw innym behawiorom (np. klasycznym FIPA u providera/koordynatora)
-            return
+        agent = self.agent
+        name = agent.name
 
         try:
             acl = AclMessage.from_spade(msg)
         except Exception as e:
-            print(f"[{self.agent.name}] parse error: {e}")
+            # traceback tylko w trybie DEBUG; w produkcji jedna linia ostrzeżenia
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.exception("[%s] parse error", name)
+            else:
+                logger.warning("[%s] parse error: %s", name, e)
             return
-        
+
+        # JID nadawcy stringifikowany raz na wiadomość; pola ACL czytane raz, dalej lokalne
+        sender = str(msg.sender)
+        cid, perf, ont = acl.conversation_id, acl.performative, acl.ontology
+
         if 'log_acl' in globals() and callable(log_acl):
-            log_acl("IN", acl, agent=self.agent.name, peer=str(msg.sender), transport="spade")
+            log_acl("IN", acl, agent=name, peer=sender, transport="spade")
         
         try:
-            from common.history import record as _rec
-            _rec(self.agent.name, "IN", acl, str(msg.sender))
+            if record is not None:
+                record(name, "IN", acl, sender)
 
-            # zamiast wewnętrznego try — prosty if z asekuracją na loggera
-            if 'logger' in globals() and hasattr(logger, 'info'):
+            # serializacja ACL tylko, gdy INFO faktycznie trafi do logu
+            if logger.isEnabledFor(logging.INFO):
                 payload = {
                     "kind": "ACL_IN",
-                    "agent": self.agent.name,
-                    "from": str(msg.sender),
-                    "acl": json.loads(acl.model_dump_json()),
+                    "agent": name,
+                    "from": sender,
+                    "acl": acl.model_dump(mode="json"),
                 }
-                logger.info(json.dumps(payload, ensure_ascii=False))
+                logger.info(_dumps(payload))
         except Exception:
             pass
 
-        if acl.conversation_id:
-            self.agent._last_sender_by_cid[acl.conversation_id] = str(msg.sender)
+        if cid:
+            agent._touch_cid(agent._last_sender_by_cid, cid, sender)
 
         # Obsługa zapytań o rejestr
-        if (acl.ontology or "").startswith("office.registry") and acl.performative == "REQUEST":
+        # (najpierw tani test performatywu — większość ruchu to nie REQUEST)
+        if perf == "REQUEST" and ont and ont.startswith(_ONT_REGISTRY):
             action = str((acl.payload or {}).get("action", "")).upper()
             if action in ("LIST", "DISCOVER"):
-                snapshot = self.agent.registry_snapshot()
+                snapshot = agent.registry_snapshot()
                 out = make_reply(
                     acl, performative="INFORM",
-                    payload={"agents": snapshot, "ts": int(time.time())},
+                    payload={"agents": {k: dict(v) for k, v in snapshot.items()}, "ts": now_s()},
                 )
-                await self.agent.send_acl(str(msg.sender), out)
+                await agent.send_acl(sender, out)
                 return
 
-        await self.agent.handle_acl(acl, str(msg.sender))
+        await agent.handle_acl(acl, sender)
+
+
+class _SendOnce(OneShotBehaviour):
+    """Jednorazowa wysyłka — tylko gdy agent nie ma jeszcze InboxBehaviour."""
+    def __init__(self, m):
+        super().__init__()
+        self._m = m
+
+    async def run(self):
+        await self.send(self._m)
 
 
 class BaseACLAgent(Agent):
@@ -125,16 +207,52 @@ class BaseACLAgent(Agent):
     - opcjonalny autopilot AI: AGENT_AUTO_AI=1 (wtedy domyślne handle_acl odsyła odpowiedź z AI).
     """
 
+    # Stan instancji w slotach (spade.Agent nie ma __slots__, więc __dict__ zostaje
+    # dla atrybutów SPADE i podklas — sloty dają szybszy dostęp w handle_acl)
+    __slots__ = (
+        "_last_sender_by_cid", "_character", "_role", "_inbox", "_pending",
+        "_persona_cache", "_persona_norm_cache", "_persona_cache_max",
+        "_resolve_cache", "_resolve_cache_version",
+        "_candidates_cache", "_candidates_cache_version", "_auto_ai",
+        "_handle_acl_impl", "_live",
+    )
+
     # Rejestr wspólny dla wszystkich instancji w tym samym procesie
     _REGISTRY: Dict[str, Dict[str, Any]] = {}
     _REG_LOCK = asyncio.Lock()
+    # Zapis pliku rejestru: flaga „brudny” + jedno zadanie zapisujące (debounce)
+    _REG_DIRTY: bool = False
+    _REG_FLUSH_TASK: Optional[asyncio.Task] = None
+    # Wersja rejestru: rośnie przy każdej mutacji, unieważnia cache instancji
+    _REG_VERSION: int = 0
+    # Niemutowalna migawka rejestru, przebudowywana tylko w _register
+    _REG_SNAPSHOT: Mapping[str, Mapping[str, Any]] = MappingProxyType({})
+    # Tokeny persony per alias (liczone przy rejestracji; poza wpisem — ten idzie do JSON)
+    _REG_TOKENS: Mapping[str, frozenset] = MappingProxyType({})
+    # Ustawiany, gdy w rejestrze jest ktoś poza pojedynczym agentem
+    _REG_READY = asyncio.Event()
+    # Liczba uruchomionych agentów w procesie — ostatni zatrzymywany zamyka klienty HTTP LLM
+    _LIVE_AGENTS: int = 0
 
     def __init__(self, jid: str, password: str):
         super().__init__(jid, password)
-        self._last_sender_by_cid: Dict[str, str] = {}  # CID -> JID
+        self._last_sender_by_cid: "OrderedDict[str, str]" = OrderedDict()  # CID -> JID (LRU)
         self._character: str = ""  # ustawiane w setup() z ENV lub domyślne
         self._role: str = ""            # rola agenta: 'coordinator' | 'provider_simple' | ''
-        self._pending: Dict[str, str] = {} 
+        self._handle_acl_impl = self._handle_autopilot  # wg roli: _bind_role_handler() w setup()
+        self._live: bool = False  # liczony w _LIVE_AGENTS (od setup() do stop())
+        self._inbox: Optional[InboxBehaviour] = None  # ustawiane w setup()
+        self._pending: "OrderedDict[str, str]" = OrderedDict()  # CID -> inicjator (LRU, ACL_MAX_CIDS)
+        # Cache adresowania (ważne tylko dla bieżącej wersji rejestru)
+        self._persona_cache: Dict[Tuple[str, bool, Tuple[str, ...]], Tuple[int, Optional[str]]] = {}
+        # drugi poziom: ten sam zbiór słów (inna kolejność/wielkość liter/interpunkcja)
+        self._persona_norm_cache: Dict[Tuple[Tuple[str, ...], bool, Tuple[str, ...]], Tuple[int, Optional[str]]] = {}
+        self._persona_cache_max: int = 256
+        self._resolve_cache: Dict[str, str] = {}
+        self._resolve_cache_version: int = -1
+        # Kandydaci routingu per (include_self, allowed) — też unieważniane wersją rejestru
+        self._candidates_cache: Dict[Tuple[bool, Optional[frozenset]], Dict[str, Dict[str, Any]]] = {}
+        self._candidates_cache_version: int = -1
         def _auto_ai_from_env() -> bool:
             return (os.getenv("AGENT_AUTO_AI", "0").strip().lower() in {"1", "true", "yes", "on"})
 
@@ -144,7 +262,9 @@ class BaseACLAgent(Agent):
 
     # --------- API rejestru ---------
     
+    # ENV nie zmienia się w trakcie działania — wyniki per alias z cache
     @staticmethod
+    @functools.lru_cache(maxsize=None)
     def _env_role_for(alias: str) -> str:
         # najpierw ROLE_<ALIAS>, potem AGENT_ROLE
         return (
@@ -154,26 +274,62 @@ class BaseACLAgent(Agent):
         ).strip().lower()
 
     @classmethod
-    def registry_snapshot(cls) -> Dict[str, Dict[str, Any]]:
-        """Płytka kopia rejestru (bezpieczna do logowania/serializacji)."""
-        return {k: dict(v) for k, v in cls._REGISTRY.items()}
+    def registry_snapshot(cls) -> Mapping[str, Mapping[str, Any]]:
+        """
+        Migawka rejestru tylko do odczytu (bez kopiowania per wywołanie); do zmian — dict(...).
+        Odczyty bez blokady; zapisy (_register) pod _REG_LOCK podmieniają całą migawkę.
+        """
+        return BaseACLAgent._REG_SNAPSHOT
 
     @classmethod
     async def _register(cls, alias: str, info: Dict[str, Any]) -> None:
         async with cls._REG_LOCK:
             cls._REGISTRY[alias] = info
-            # Opcjonalny zrzut na dysk
+            # celowo na klasie bazowej — cls bywa podklasą (wspólny licznik)
+            BaseACLAgent._REG_VERSION += 1
+            BaseACLAgent._REG_SNAPSHOT = MappingProxyType(
+                {k: MappingProxyType(dict(v)) for k, v in cls._REGISTRY.items()}
+            )
+            BaseACLAgent._REG_TOKENS = MappingProxyType(
+                {**BaseACLAgent._REG_TOKENS, alias: _info_tokens(info)}
+            )
+            if len(cls._REGISTRY) > 1:
+                BaseACLAgent._REG_READY.set()
+        # Zrzut na dysk: zbiorczo, najwyżej raz na _REG_FLUSH_DELAY s (debounce)
+        BaseACLAgent._schedule_registry_flush()
+
+    @classmethod
+    def _schedule_registry_flush(cls) -> None:
+        BaseACLAgent._REG_DIRTY = True
+        task = BaseACLAgent._REG_FLUSH_TASK
+        if task is None or task.done():
+            BaseACLAgent._REG_FLUSH_TASK = asyncio.create_task(cls._flush_registry())
+
+    @staticmethod
+    async def _flush_registry() -> None:
+        """Jedyny zapisujący: czeka chwilę, zbiera zmiany i zapisuje migawkę poza pętlą zdarzeń."""
+        while BaseACLAgent._REG_DIRTY:
+            await asyncio.sleep(_REG_FLUSH_DELAY)
+            BaseACLAgent._REG_DIRTY = False
+            snapshot = BaseACLAgent._REG_SNAPSHOT
             try:
-                os.makedirs(os.path.dirname(_REG_PATH) or ".", exist_ok=True)
-                with open(_REG_PATH, "w", encoding="utf-8") as f:
-                    json.dump(cls._REGISTRY, f, ensure_ascii=False, indent=2)
+                data = _dumps_bytes({k: dict(v) for k, v in snapshot.items()}, indent=True)
+                await asyncio.to_thread(_write_registry_file, data)
             except Exception as e:
                 logging.debug(f"[base] write registry file failed: {e}")
 
-    def agents(self) -> Dict[str, Dict[str, Any]]:
+    def agents(self) -> Mapping[str, Mapping[str, Any]]:
         """Skrót: migawka rejestru z poziomu instancji."""
         return self.registry_snapshot()
 
+    async def wait_for_peers(self, timeout: float = 2.0) -> bool:
+        """Poczekaj (max timeout s), aż w rejestrze pojawi się ktoś poza nami."""
+        try:
+            await asyncio.wait_for(BaseACLAgent._REG_READY.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
     # --------- Alias/JID/resolve ---------
 
     @staticmethod
@@ -195,16 +351,34 @@ class BaseACLAgent(Agent):
         """
         if "@" in alias_or_jid:
             return alias_or_jid
-        snapshot = self.registry_snapshot()
-        if alias_or_jid in snapshot:
-            return snapshot[alias_or_jid]["jid"]
-        env_jid = os.getenv(f"JID_{alias_or_jid.upper()}")
-        return env_jid or alias_or_jid
+        version = BaseACLAgent._REG_VERSION
+        if self._resolve_cache_version != version:
+            self._resolve_cache.clear()
+            self._resolve_cache_version = version
+        cached = self._resolve_cache.get(alias_or_jid)
+        if cached is not None:
+            return cached
+        # odczyt bez blokady: migawka jest niemutowalna, _register podmienia ją w całości
+        info = BaseACLAgent._REG_SNAPSHOT.get(alias_or_jid)
+        if info is not None:
+            out = info["jid"]
+        else:
+            out = _env_jid_for(alias_or_jid) or alias_or_jid
+        self._resolve_cache[alias_or_jid] = out
+        return out
 
     def last_sender_for(self, conversation_id: str) -> Optional[str]:
         """Zwraca ostatniego nadawcę dla danego CID (jeśli znany)."""
         return self._last_sender_by_cid.get(conversation_id)
 
+    @staticmethod
+    def _touch_cid(mapping: "OrderedDict[str, Any]", cid: str, value: Any) -> None:
+        """Wpis per-CID jako najświeższy; powyżej ACL_MAX_CIDS usuń najstarsze."""
+        mapping[cid] = value
+        mapping.move_to_end(cid)
+        while len(mapping) > _MAX_CIDS:
+            mapping.popitem(last=False)
+
     # --------- Character (persona) ---------
 
     def character(self) -> str:
@@ -217,7 +391,7 @@ class BaseACLAgent(Agent):
         alias = self.alias()
 
         async def _upd():
-            info = self.registry_snapshot().get(alias, {})
+            info = dict(self.registry_snapshot().get(alias, {}))
             if info:
                 info["character"] = self._character
                 await self._register(alias, info)
@@ -225,6 +399,7 @@ class BaseACLAgent(Agent):
         asyncio.create_task(_upd())
 
     @staticmethod
+    @functools.lru_cache(maxsize=None)
     def _env_character_for(alias: str) -> str:
         """
         Poszuka charakteru w ENV:
@@ -240,14 +415,6 @@ class BaseACLAgent(Agent):
 
     # --------- Routing po charakterze ---------
 
-    @staticmethod
-    def _score_text_overlap(prompt: str, persona: str) -> int:
-        """Prosta heurystyka: liczba wspólnych tokenów alfanum. (lowercase)."""
-        import re
-        tok = lambda s: set(re.findall(r"[a-z0-9]{3,}", s.lower()))
-        a, b = tok(prompt), tok(persona)
-        return len(a & b)
-
     def choose_agent_by_character(
         self,
         prompt: str,
@@ -260,137 +427,211 @@ class BaseACLAgent(Agent):
         - jeśli dostępne AI (common.llm.pick_agent) i klucz API → użyj AI,
         - inaczej heurystyka overlap.
         Parametr allowed — ogranicz do danej listy aliasów.
+        Wynik jest zapamiętywany per (prompt, include_self, allowed) do czasu
+        kolejnej mutacji rejestru; drugi poziom cache łapie ten sam prompt
+        zapisany inaczej (wielkość liter, interpunkcja, białe znaki). Kolejność
+        i powtórzenia słów zostają w kluczu — pick_agent (AI) widzi cały tekst.
         """
-        registry = self.registry_snapshot()
-        if not registry:
-            return None
+        version = BaseACLAgent._REG_VERSION
+        allowed_key = tuple(allowed or ())
+        key = (prompt, include_self, allowed_key)
+        hit = self._persona_cache.get(key)
+        if hit is not None and hit[0] == version:
+            return hit[1]
+
+        words = self._persona_words(prompt)
+        norm_key = (words, include_self, allowed_key)
+        hit = self._persona_norm_cache.get(norm_key) if words else None
+        if hit is not None and hit[0] == version:
+            choice = hit[1]
+        else:
+            choice = self._choose_agent_by_character(prompt, include_self=include_self, allowed=allowed)
+            if words:
+                if len(self._persona_norm_cache) >= self._persona_cache_max:
+                    self._persona_norm_cache.clear()
+                self._persona_norm_cache[norm_key] = (version, choice)
+
+        if len(self._persona_cache) >= self._persona_cache_max:
+            # prompty z konsoli (say) są dowolne — nie pozwól cache rosnąć bez końca
+            self._persona_cache.clear()
+        self._persona_cache[key] = (version, choice)
+        return choice
 
-        candidates: List[Tuple[str, Dict[str, Any]]] = []
-        my_alias = self.alias()
-        for alias, info in registry.items():
-            if not include_self and alias == my_alias:
-                continue
-            if allowed and alias not in allowed:
-                continue
-            candidates.append((alias, info))
+    @staticmethod
+    def _persona_words(prompt: str) -> Tuple[str, ...]:
+        """Znormalizowana sekwencja słów promptu (klucz drugiego poziomu cache)."""
+        return tuple(w for w in (t.strip(string.punctuation) for t in prompt.casefold().split()) if w)
 
+    def _choose_agent_by_character(
+        self,
+        prompt: str,
+        *,
+        include_self: bool,
+        allowed: Optional[List[str]],
+    ) -> Optional[str]:
+        candidates = self._candidates(include_self, allowed)
         if not candidates:
             return None
 
         # 1) AI, jeśli dostępne
         if pick_agent is not None:
             try:
-                choice = pick_agent(prompt, {a: i for a, i in candidates})
-                if choice and any(choice == a for a, _ in candidates):
+                choice = pick_agent(prompt, candidates)
+                if choice and choice in candidates:
                     return choice
             except Exception as e:
                 logging.debug(f"[base] pick_agent failed, fallback used: {e}")
 
-        # 2) Heurystyka
+        # 2) Heurystyka (tokeny promptu liczone raz, nie per kandydat)
+        prompt_tokens = _text_tokens(prompt)
+        reg_tokens = BaseACLAgent._REG_TOKENS
         scored = []
-        for alias, info in candidates:
-            persona = f"{info.get('character','')} {info.get('class','')}"
-            scored.append((self._score_text_overlap(prompt, persona), alias))
+        for alias, info in candidates.items():
+            tokens = reg_tokens.get(alias)
+            if tokens is None:
+                tokens = _info_tokens(info)
+            scored.append((len(prompt_tokens & tokens), alias))
         scored.sort(key=lambda t: (-t[0], t[1]))
         return scored[0][1] if scored else None
 
+    def _candidates(self, include_self: bool, allowed: Optional[List[str]]) -> Dict[str, Dict[str, Any]]:
+        """
+        Kandydaci do routingu (alias -> kopia wpisu) po filtrach include_self/allowed.
+        Liczone raz na wersję rejestru i zestaw filtrów; nie modyfikować wyniku.
+        """
+        version = BaseACLAgent._REG_VERSION
+        if self._candidates_cache_version != version:
+            self._candidates_cache.clear()
+            self._candidates_cache_version = version
+        key = (include_self, frozenset(allowed) if allowed else None)
+        hit = self._candidates_cache.get(key)
+        if hit is not None:
+            return hit
+        my_alias = self.alias()
+        out = {
+            alias: dict(info)
+            for alias, info in self.registry_snapshot().items()
+            if (include_self or alias != my_alias) and (not allowed or alias in allowed)
+        }
+        self._candidates_cache[key] = out
+        return out
+
     # --------- Cykl życia ---------
 
     async def setup(self):
-        # 1) Uruchom wspólną skrzynkę odbiorczą AclMessage
-        self.add_behaviour(InboxBehaviour(), Template())
+        # 1) Uruchom wspólną skrzynkę odbiorczą AclMessage (służy też do wysyłki send_acl)
+        self._inbox = InboxBehaviour()
+        self.add_behaviour(self._inbox, Template())
 
         # 2) Auto-rejestracja w rejestrze procesu (+ charakter)
         alias = self.alias()
         self._character = self._env_character_for(alias)
         self._role = self._env_role_for(alias)
+        self._bind_role_handler()
 
         info = {
             "alias": alias,
             "jid": str(self.jid),
             "class": self.__class__.__name__,
             "protocols": ["fipa-request"],
-            "ontologies": ["office.demo", "office.registry"],
+            "ontologies": ["office.demo", _ONT_REGISTRY],
             "character": self._character,
             "role": self._role or "generic",    # <— DODAJ
             "ts": int(time.time()),
         }
         await self._register(alias, info)
 
+        BaseACLAgent._LIVE_AGENTS += 1
+        self._live = True
+
         print(f"[{self.name}] up (alias={alias})")
 
+    async def stop(self):
+        # klienty HTTP są wspólne dla procesu: zamyka je dopiero ostatni agent
+        if self._live:
+            self._live = False
+            BaseACLAgent._LIVE_AGENTS -= 1
+            if BaseACLAgent._LIVE_AGENTS == 0 and aclose_clients is not None:
+                try:
+                    await aclose_clients()
+                except Exception as e:
+                    logging.warning("[%s] zamknięcie klientów HTTP nieudane: %s", self.alias(), e)
+        return await super().stop()
+
     # --------- Domyślne handle_acl ---------
 
     async def handle_acl(self, acl: AclMessage, sender_jid: str):
-        perf = (acl.performative or "").upper()
+        # obsługa wybrana raz w setup() wg roli (bez łańcucha porównań per wiadomość)
+        return await self._handle_acl_impl(acl, sender_jid)
+
+    def _bind_role_handler(self) -> None:
+        self._handle_acl_impl = {
+            "coordinator": self._handle_coordinator,
+            "provider_simple": self._handle_provider_simple,
+        }.get(self._role, self._handle_autopilot)
+
+    # --- tryb KOORDYNATORA: przyjmuje REQUEST od człowieka/AI, forwarduje do właściwego agenta,
+    #     a wyniki (INFORM/FAILURE/REFUSE) odsyła inicjatorowi ---
+    async def _handle_coordinator(self, acl: AclMessage, sender_jid: str):
+        perf = acl.performative   # już kanoniczny (walidator AclMessage)
         cid = acl.conversation_id
+        if perf == "REQUEST":
+            # zapamiętaj komu oddać wynik
+            if cid:
+                # bez terminalnej odpowiedzi wpis i tak wypadnie (limit ACL_MAX_CIDS)
+                self._touch_cid(self._pending, cid, sender_jid)
+
+            # szybkie AGREE do inicjatora (wysyłane razem z przekazaniem niżej)
+            agree = make_reply(acl, performative="AGREE", payload={"text": "przyjęto do realizacji"})
+
+            # wybór adresata po charakterze
+            user_text = ""
+            if isinstance(acl.payload, dict):
+                user_text = str(acl.payload.get("text") or acl.payload.get("user_text") or "")
+
+            target_alias = self.choose_agent_by_character(user_text or "zamówienie pieczywa") or "provider"
+            target_jid = self.resolve(target_alias)
+
+            down_req = make_reply(acl, performative="REQUEST", payload=acl.payload or {"text": user_text})
+            # niezależne wysyłki: AGREE do inicjatora i REQUEST do wykonawcy równolegle
+            await asyncio.gather(
+                self.send_acl(sender_jid, agree),
+                self.send_acl(target_jid, down_req),
+            )
+            logging.info("[%s] REQUEST → %s (%s)", self.alias(), target_alias, cid)
+            return
 
-        # --- tryb KOORDYNATORA: przyjmuje REQUEST od człowieka/AI, forwarduje do właściwego agenta,
-        #     a wyniki (INFORM/FAILURE/REFUSE) odsyła inicjatorowi ---
-        if self._role == "coordinator":
-            if perf == "REQUEST":
-                # zapamiętaj komu oddać wynik
-                if cid:
-                    self._pending[cid] = sender_jid
-
-                # szybkie AGREE do inicjatora
-                from common.fipa import make_reply
-                agree = make_reply(acl, performative="AGREE", payload={"text": "przyjęto do realizacji"})
-                await self.send_acl(sender_jid, agree)
-
-                # wybór adresata po charakterze
-                user_text = ""
-                if isinstance(acl.payload, dict):
-                    user_text = str(acl.payload.get("text") or acl.payload.get("user_text") or "")
-
-                target_alias = self.choose_agent_by_character(user_text or "zamówienie pieczywa") or "provider"
-                target_jid = self.resolve(target_alias)
-
-                down_req = make_reply(acl, performative="REQUEST", payload=acl.payload or {"text": user_text})
-                await self.send_acl(target_jid, down_req)
-                logging.info("[%s] REQUEST → %s (%s)", self.alias(), target_alias, cid)
-                return
+        if perf in ("INFORM", "FAILURE", "REFUSE"):
+            reply_to = self._pending.get(cid) or sender_jid
+            fwd = make_reply(acl, performative=perf, payload=acl.payload)
+            await self.send_acl(reply_to, fwd)
+            logging.info("[%s] %s (%s) → przekazano do inicjatora", self.alias(), perf, cid)
+            self._pending.pop(cid, None)
+            return
 
-            if perf in ("INFORM", "FAILURE", "REFUSE"):
-                reply_to = self._pending.get(cid) or sender_jid
-                from common.fipa import make_reply
-                fwd = make_reply(acl, performative=perf, payload=acl.payload)
-                await self.send_acl(reply_to, fwd)
-                logging.info("[%s] %s (%s) → przekazano do inicjatora", self.alias(), perf, cid)
-                if perf in ("INFORM", "FAILURE", "REFUSE"):
-                    self._pending.pop(cid, None)
-                return
+        # AGREE od providera można zignorować albo forwardować — tu ignorujemy “szum”
+        return
 
-            # AGREE od providera można zignorować albo forwardować — tu ignorujemy “szum”
+    # --- tryb PROSTY PROVIDER: na REQUEST → AGREE + po chwili INFORM ---
+    async def _handle_provider_simple(self, acl: AclMessage, sender_jid: str):
+        if acl.performative != "REQUEST":
             return
+        agree = make_reply(acl, performative="AGREE", payload={"text": "ok, realizuję"})
+        await self.send_acl(sender_jid, agree)
 
-        # --- tryb PROSTY PROVIDER: na REQUEST → AGREE + po chwili INFORM ---
-        if self._role == "provider_simple":
-            if perf != "REQUEST":
-                return
-            from common.fipa import make_reply
-            agree = make_reply(acl, performative="AGREE", payload={"text": "ok, realizuję"})
-            await self.send_acl(sender_jid, agree)
+        txt = "zamówienie zrealizowane"
+        if isinstance(acl.payload, dict) and acl.payload.get("text"):
+            txt = f"zrealizowano: {acl.payload['text']}"
 
-            await asyncio.sleep(0.5)
-            txt = "zamówienie zrealizowane"
-            if isinstance(acl.payload, dict) and acl.payload.get("text"):
-                txt = f"zrealizowano: {acl.payload['text']}"
+        # INFORM po 0.5 s z timera pętli — skrzynka nie czeka, żadna korutyna nie śpi
+        inform = make_reply(acl, performative="INFORM", payload={"text": txt})
+        self._send_acl_later(0.5, sender_jid, inform)
 
-            inform = make_reply(acl, performative="INFORM", payload={"text": txt})
-            await self.send_acl(sender_jid, inform)
-            return
-
-        # --- fallback: autopilot AI, jeśli włączony i dostępny ---
+    # --- fallback: autopilot AI, jeśli włączony i dostępny ---
+    async def _handle_autopilot(self, acl: AclMessage, sender_jid: str):
         if self._auto_ai and ai_respond_to_acl is not None:
             try:
-                # IN do historii (jeśli jest)
-                try:
-                    from common.history import record as _rec
-                    _rec(self.name, "IN", acl, sender_jid)
-                except Exception:
-                    pass
-
+                # IN jest już w historii (InboxBehaviour zapisuje każdą przychodzącą wiadomość)
                 reply_acl = await ai_respond_to_acl(self, acl, sender_jid)
                 await self.send_acl(sender_jid, reply_acl)
                 return
@@ -400,33 +641,55 @@ class BaseACLAgent(Agent):
         # w pozostałych trybach brak domyślnej akcji
         return
 
+    async def handle_classic(self, msg) -> None:
+        """Nie-JSON (klasyczny SPADE+FIPA) z InboxBehaviour; domyślnie ignorowany."""
+        return
+
     # --------- Wysyłka ---------
 
-    async def send_acl(self, to_jid: str, acl: AclMessage):
+    def _send_acl_later(self, delay: float, to_jid: str, acl: AclMessage) -> None:
+        """Zaplanuj send_acl za delay s (loop.call_later); zadanie powstaje dopiero w terminie."""
+        asyncio.get_running_loop().call_later(delay, self._spawn_send_acl, to_jid, acl)
+
+    def _spawn_send_acl(self, to_jid: str, acl: AclMessage) -> None:
+        task = asyncio.ensure_future(self.send_acl(to_jid, acl))
+        _BG_TASKS.add(task)   # silna referencja do końca wysyłki
+        task.add_done_callback(_BG_TASKS.discard)
+
+    async def send_acl_many(self, to_jids: List[str], acl: AclMessage):
+        """Ta sama AclMessage do wielu adresatów: JSON body serializowane raz."""
+        raw = acl.model_dump_json()
+        await asyncio.gather(*(self.send_acl(j, acl, raw=raw) for j in to_jids))
+
+    async def send_acl(self, to_jid: str, acl: AclMessage, *, raw: Optional[str] = None):
         """Wysyłka AclMessage jako SPADE Message (JSON w body, FIPA-meta w metadata)
-        przez OneShotBehaviour (używa Behaviour.send, które jest stabilne)."""
-        spade_msg = acl.to_spade(to_jid, str(self.jid))
-
-        class _SendOnce(OneShotBehaviour):
-            def __init__(self, m):
-                super().__init__()
-                self._m = m
-            async def run(self):
-                await self.send(self._m)
-                
+        przez działające InboxBehaviour agenta (self._inbox.send); przed setup() —
+        przez jednorazowy _SendOnce."""
+        spade_msg = acl.to_spade(to_jid, str(self.jid), raw=raw)
+
         try:
-            from common.history import record as _rec
-            _rec(self.name, "OUT", acl, to_jid)
+            if record is not None:
+                record(self.name, "OUT", acl, to_jid)
             try:
                 log_acl("OUT", acl, agent=self.name, peer=to_jid, transport="spade")
             except Exception:
                 pass
             try:
-                logger.info(json.dumps({"kind":"ACL_OUT","agent": self.name, "to": to_jid, "acl": json.loads(acl.model_dump_json())}, ensure_ascii=False))
+                if logger.isEnabledFor(logging.INFO):
+                    logger.info(_dumps({"kind":"ACL_OUT","agent": self.name, "to": to_jid, "acl": _loads(spade_msg.body)}))
             except Exception:
                 pass
         except Exception:
             pass        
 
+        # Wysyłka przez działające InboxBehaviour (bez nowego behawioru per wiadomość);
+        # przed setup() — jednorazowy _SendOnce jak dawniej
+        inbox = self._inbox
+        if inbox is not None and inbox.agent is self:
+            try:
+                await inbox.send(spade_msg)
+            except Exception as e:
+                logger.warning("[%s] send to %s failed: %s", self.name, to_jid, e)
+            return
         self.add_behaviour(_SendOnce(spade_msg))
 
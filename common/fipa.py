@@ -2,23 +2,70 @@
 # Wspólne narzędzia FIPA-ACL: czas/ID, reguły przejść, budowa odpowiedzi
 # + funkcje kompatybilności (acl_msg, perf, conv_id, is_fipa_request).
 
+import os
+import sys
+import time
+from collections import deque
 from datetime import datetime, timedelta, timezone
-from typing import Optional, Dict, Any
-from uuid import uuid4
+from types import MappingProxyType
+from typing import Optional, Dict, Any, Mapping, Tuple
 import logging
-import json
 
 from spade.message import Message
-from common.acl import AclMessage, ALLOWED_PERFORMATIVES
+from common.acl import AclMessage, ALLOWED_PERFORMATIVES, ACL_SERIALIZER
+from common.jsonutil import dumps as _dumps
 
 logger = logging.getLogger("common.fipa")
 
 
+# ---------- Stałe metadanych (internowane — te same obiekty we wszystkich wiadomościach) ----------
+
+ACL_PROTOCOL_REQUEST = sys.intern("fipa-request")
+ACL_ONTOLOGY_DEFAULT = sys.intern("office.demo")
+ACL_LANG_TEXT = sys.intern("text")
+ACL_LANG_JSON = sys.intern("json")
+
+PERF_REQUEST = sys.intern("REQUEST")
+PERF_AGREE = sys.intern("AGREE")
+PERF_REFUSE = sys.intern("REFUSE")
+PERF_INFORM = sys.intern("INFORM")
+PERF_FAILURE = sys.intern("FAILURE")
+
+_EMPTY_MD: Mapping[str, str] = MappingProxyType({})
+
+def inherit_md(src_md: Optional[Mapping[str, str]], cid: str, performative: Optional[str] = None) -> Dict[str, str]:
+    """
+    Metadane FIPA dla odpowiedzi/AUDIT-u: protocol, conversation_id, ontology,
+    language przejęte z src_md (albo domyślne) + opcjonalnie performative.
+    """
+    s = src_md or _EMPTY_MD
+    md = {
+        "protocol": s.get("protocol", ACL_PROTOCOL_REQUEST),
+        "conversation_id": s.get("conversation_id", cid),
+        "ontology": s.get("ontology", ACL_ONTOLOGY_DEFAULT),
+        "language": s.get("language", ACL_LANG_TEXT),
+    }
+    if performative:
+        md["performative"] = performative
+    return md
+
+
 # ---------- Czas i identyfikatory ----------
 
 def now_utc() -> datetime:
     return datetime.now(timezone.utc)
 
+# Zegar ścienny w sekundach odświeżany co najwyżej raz na sekundę (ts w rekordach ma rozdzielczość 1 s)
+_NOW_SEC = [int(time.time())]
+_NOW_MONO = [time.monotonic()]
+
+def now_s() -> int:
+    m = time.monotonic()
+    if m - _NOW_MONO[0] >= 1.0:
+        _NOW_SEC[0] = int(time.time())
+        _NOW_MONO[0] = m
+    return _NOW_SEC[0]
+
 def _to_iso_utc(dt: datetime) -> str:
     if dt.tzinfo is None:
         dt = dt.replace(tzinfo=timezone.utc)
@@ -28,19 +75,43 @@ def _to_iso_utc(dt: datetime) -> str:
 def iso_in(seconds: int) -> str:
     return _to_iso_utc(now_utc() + timedelta(seconds=seconds))
 
+# Pula losowych sufiksów CID (8 hex, jak uuid4().hex[:8]) — jeden os.urandom na partię
+_ID_POOL: deque = deque()
+_ID_POOL_BATCH = 256
+
+def _refill_id_pool() -> None:
+    blob = os.urandom(4 * _ID_POOL_BATCH).hex()
+    _ID_POOL.extend(blob[i:i + 8] for i in range(0, len(blob), 8))
+
 def new_conv_id(prefix: str = "conv") -> str:
-    return f"{prefix}-{uuid4().hex[:8]}"
+    try:
+        suffix = _ID_POOL.popleft()
+    except IndexError:
+        _refill_id_pool()
+        suffix = _ID_POOL.popleft()
+    return f"{prefix}-{suffix}"
+
+# Domyślny termin (brak reply_by) z cache odświeżanego raz na sekundę — ISO ma rozdzielczość 1 s
+_REPLY_BY_CACHE: Dict[int, Tuple[float, str]] = {}
+
+def _cached_reply_by(seconds: int) -> str:
+    m = time.monotonic()
+    hit = _REPLY_BY_CACHE.get(seconds)
+    if hit is None or m - hit[0] >= 1.0:
+        hit = (m, iso_in(seconds))
+        _REPLY_BY_CACHE[seconds] = hit
+    return hit[1]
 
 def ensure_reply_by(value: Optional[str], *, min_seconds: int = 5, default_seconds: int = 30) -> Optional[str]:
     if value is None:
-        return iso_in(default_seconds)
+        return _cached_reply_by(default_seconds)
     try:
         if value.endswith("Z"):
             dt = datetime.fromisoformat(value.replace("Z", "+00:00"))
         else:
             dt = datetime.fromisoformat(value)
     except Exception:
-        return iso_in(default_seconds)
+        return _cached_reply_by(default_seconds)
     if dt.tzinfo is None:
         dt = dt.replace(tzinfo=timezone.utc)
     dt = dt.astimezone(timezone.utc)
@@ -52,19 +123,24 @@ def ensure_reply_by(value: Optional[str], *, min_seconds: int = 5, default_secon
 
 # ---------- Reguły przejść (prosty kanon) ----------
 
-_REQUEST_REPLIES = {"AGREE", "REFUSE"}
-_AFTER_AGREE = {"INFORM", "FAILURE"}
+_REQUEST_REPLIES = frozenset({PERF_AGREE, PERF_REFUSE})
+_AFTER_AGREE = frozenset({PERF_INFORM, PERF_FAILURE})
+_ANY_REPLY = frozenset(ALLOWED_PERFORMATIVES)
+
+# Tablica przejść: kanoniczny performatyw przychodzący (lub None) -> dozwolone odpowiedzi
+_NEXT_PERF: Dict[Optional[str], frozenset] = {p: _ANY_REPLY for p in ALLOWED_PERFORMATIVES}
+_NEXT_PERF.update({None: _ANY_REPLY, PERF_REQUEST: _REQUEST_REPLIES, PERF_AGREE: _AFTER_AGREE})
 
 def is_valid_transition(incoming_perf: Optional[str], outgoing_perf: str) -> bool:
+    # szybka ścieżka: oba kanoniczne (AclMessage) — jedno wyszukanie, bez upper()
+    nxt = _NEXT_PERF.get(incoming_perf)
+    if nxt is not None and outgoing_perf in nxt:
+        return True
+    # zapisy niekanoniczne ("agree", " Inform") albo odmowa z szybkiej ścieżki
     out_up = outgoing_perf.upper()
     if incoming_perf is None:
-        return out_up in ALLOWED_PERFORMATIVES
-    inc_up = incoming_perf.upper()
-    if inc_up == "REQUEST":
-        return out_up in _REQUEST_REPLIES
-    if inc_up == "AGREE":
-        return out_up in _AFTER_AGREE
-    return out_up in ALLOWED_PERFORMATIVES
+        return out_up in _ANY_REPLY
+    return out_up in _NEXT_PERF.get(incoming_perf.upper(), _ANY_REPLY)
 
 
 # ---------- Budowa wiadomości (nowy styl: AclMessage) ----------
@@ -96,7 +172,8 @@ def build_message(
         payload=data,
     )
     try:
-        logger.info(json.dumps({"kind": "ACL_MAKE_REPLY", "from_performative": incoming.performative, "to_performative": perf_up, "conversation_id": incoming.conversation_id, "reply": json.loads(reply_obj.model_dump_json())}, ensure_ascii=False))
+        if logger.isEnabledFor(logging.INFO):
+            logger.info(_dumps({"kind": "ACL_BUILD", "performative": reply_obj.performative, "conversation_id": conversation_id, "message": ACL_SERIALIZER.to_python(reply_obj, mode="json")}))
     except Exception:
         pass
     return reply_obj
@@ -132,7 +209,8 @@ def make_reply(
         payload=data,
     )
     try:
-        logger.info(json.dumps({"kind": "ACL_MAKE_REPLY", "from_performative": incoming.performative, "to_performative": perf_up, "conversation_id": incoming.conversation_id, "reply": json.loads(reply_obj.model_dump_json())}, ensure_ascii=False))
+        if logger.isEnabledFor(logging.INFO):
+            logger.info(_dumps({"kind": "ACL_MAKE_REPLY", "from_performative": incoming.performative, "to_performative": perf_up, "conversation_id": incoming.conversation_id, "reply": ACL_SERIALIZER.to_python(reply_obj, mode="json")}))
     except Exception:
         pass
     return reply_obj
@@ -141,8 +219,6 @@ def make_reply(
 # ---------- Funkcje kompatybilności „po staremu” ----------
 # (używane przez obecne pliki agentów; teraz importuj z common.fipa)
 
-ACL_PROTOCOL_REQUEST = "fipa-request"
-
 def acl_msg(
     to: str,
     performative: str,
@@ -150,8 +226,8 @@ def acl_msg(
     protocol: str = ACL_PROTOCOL_REQUEST,
     conv_id: str | None = None,
     reply_by: str | None = None,
-    ontology: str = "office.demo",
-    language: str = "text",
+    ontology: str = ACL_ONTOLOGY_DEFAULT,
+    language: str = ACL_LANG_TEXT,
 ) -> Message:
     """
     Tworzy prosty SPADE Message (body = tekst) z metadanymi FIPA
@@ -168,19 +244,30 @@ def acl_msg(
         m.set_metadata("reply_by", ensure_reply_by(reply_by))
     return m
 
+def _header(msg: Message) -> tuple:
+    """(performative, conversation_id) z metadanych — liczone raz i zapamiętane na obiekcie wiadomości."""
+    d = msg.__dict__
+    hdr = d.get("_fipa_hdr")
+    if hdr is None:
+        md = msg.metadata or _EMPTY_MD
+        hdr = d["_fipa_hdr"] = (
+            md.get("performative", "").upper(),
+            md.get("conversation_id") or md.get("conversation-id", ""),
+        )
+    return hdr
+
 def perf(msg: Message) -> str:
-    return (msg.metadata or {}).get("performative", "").upper()
+    return _header(msg)[0]
 
 def conv_id(msg: Message) -> str:
-    md = msg.metadata or {}
-    return md.get("conversation_id") or md.get("conversation-id", "")
+    return _header(msg)[1]
 
 def protocol_of(msg: Message) -> str:
     return (msg.metadata or {}).get("protocol", "")
 
 def is_fipa_request(msg: Message) -> bool:
-    md = msg.metadata or {}
-    return md.get("protocol") == ACL_PROTOCOL_REQUEST and (md.get("performative", "").upper() in ALLOWED_PERFORMATIVES)
+    md = msg.metadata or _EMPTY_MD
+    return md.get("protocol") == ACL_PROTOCOL_REQUEST and perf(msg) in ALLOWED_PERFORMATIVES
 
 # --- Alias kompatybilności dla starszego kodu ---
 def protocol(msg):
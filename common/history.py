@@ -1,27 +1,39 @@
 # common/history.py
 from __future__ import annotations
 
-import logging
-
+import os
 import logging
 
 from collections import defaultdict, deque
+from itertools import islice
 from typing import Deque, Dict, Literal, List, Tuple, Optional
 from common.acl import AclMessage
+from common.jsonutil import dumps as _dumps, canonical as _canon
+
+logger = logging.getLogger("common.history")
 
 Direction = Literal["IN", "OUT"]
 
-# Pamięć procesowa: agent_name -> deque[(Direction, AclMessage, peer_jid)]
+# Limit wpisów na agenta — ENV czytany raz przy imporcie
 def _default_limit() -> int:
-    import os
-logger = logging.getLogger("common.history")
     try:
         return max(1, int(os.getenv("ACL_HISTORY_LIMIT", "20")))
     except Exception:
         return 20
 
+_HISTORY_LIMIT = _default_limit()
+
+# Pamięć procesowa: agent_name -> deque[(Direction, AclMessage, peer_jid)]
 _STORE: Dict[str, Deque[Tuple[Direction, AclMessage, str]]] = defaultdict(
-    lambda: deque(maxlen=_default_limit())
+    lambda: deque(maxlen=_HISTORY_LIMIT)
+)
+# Indeks wątków: agent_name -> conversation_id -> te same wpisy co w _STORE (w tej samej kolejności);
+# wpis wypadający z _STORE jest zdejmowany też stąd, więc indeks nie rośnie ponad limit.
+_THREADS: Dict[str, Dict[str, Deque[Tuple[Direction, AclMessage, str]]]] = defaultdict(dict)
+# Fragmenty JSON wierszy promptu, równoległe do _STORE (ten sam maxlen, ten sam indeks);
+# None = jeszcze nie serializowany — uzupełniane leniwie w format_for_prompt()
+_STORE_JSON: Dict[str, Deque[Optional[bytes]]] = defaultdict(
+    lambda: deque(maxlen=_HISTORY_LIMIT)
 )
 
 __all__ = [
@@ -29,24 +41,55 @@ __all__ = [
     "recent",
     "recent_thread",
     "format_for_prompt",
+    "format_for_key",
     "clear",
     "stats",
 ]
 
 
+class _HistoryLine:
+    """Leniwa linia logu ACL_HISTORY: serializacja w __str__, nie przy wywołaniu record()."""
+    __slots__ = ("agent", "direction", "peer", "acl")
+
+    def __init__(self, agent: str, direction: Direction, peer: str, acl: AclMessage):
+        self.agent, self.direction, self.peer, self.acl = agent, direction, peer, acl
+
+    def __str__(self) -> str:
+        try:
+            return _dumps({
+                "kind": "ACL_HISTORY",
+                "agent": self.agent,
+                "direction": self.direction,
+                "peer": self.peer,
+                "acl": self.acl.model_dump(mode="json"),
+            })
+        except Exception:
+            return f"ACL_HISTORY {self.agent} {self.direction} {self.peer}"
+
+
 def record(agent_name: str, direction: Direction, acl: AclMessage, peer_jid: str) -> None:
-    \"\"\"Dodaj wpis historii dla danego agenta.\"\"\"
-    try:
-        logger.info(json.dumps({
-            "kind": "ACL_HISTORY",
-            "agent": agent_name,
-            "direction": direction,
-            "peer": peer_jid,
-            "acl": json.loads(acl.model_dump_json())
-        }, ensure_ascii=False))
-    except Exception:
-        pass
-    _STORE[agent_name].append((direction, acl, peer_jid))
+    """Dodaj wpis historii dla danego agenta."""
+    if logger.isEnabledFor(logging.INFO):
+        # JSON powstaje dopiero przy formatowaniu rekordu (tylko gdy handler go przyjmie)
+        logger.info("%s", _HistoryLine(agent_name, direction, peer_jid, acl))
+    buf = _STORE[agent_name]
+    threads = _THREADS[agent_name]
+    if len(buf) == buf.maxlen:
+        # najstarszy wpis zaraz wypadnie z bufora — zdejmij go z indeksu wątku
+        old_cid = buf[0][1].conversation_id or ""
+        dq = threads.get(old_cid)
+        if dq:
+            dq.popleft()
+            if not dq:
+                del threads[old_cid]
+    entry = (direction, acl, peer_jid)
+    buf.append(entry)
+    _STORE_JSON[agent_name].append(None)
+    cid = acl.conversation_id or ""
+    dq = threads.get(cid)
+    if dq is None:
+        dq = threads[cid] = deque()
+    dq.append(entry)
 
 
 def recent(agent_name: str, limit: int | None = None) -> List[Tuple[Direction, AclMessage, str]]:
@@ -54,20 +97,27 @@ def recent(agent_name: str, limit: int | None = None) -> List[Tuple[Direction, A
     buf = _STORE.get(agent_name)
     if not buf:
         return []
-    data = list(buf)
-    return data if limit is None else data[-limit:]
+    return _tail(buf, limit)
 
 
 def recent_thread(
     agent_name: str, conversation_id: str, limit: int | None = None
 ) -> List[Tuple[Direction, AclMessage, str]]:
     """Zwróć wpisy ograniczone do jednego conversation_id."""
-    items = [
-        (d, a, p)
-        for (d, a, p) in _STORE.get(agent_name, [])
-        if (a.conversation_id or "") == conversation_id
-    ]
-    return items if limit is None else items[-limit:]
+    dq = (_THREADS.get(agent_name) or {}).get(conversation_id)
+    if not dq:
+        return []
+    return _tail(dq, limit)
+
+
+def _tail(buf: Deque[Tuple[Direction, AclMessage, str]], limit: int | None) -> List[Tuple[Direction, AclMessage, str]]:
+    """Ostatnie `limit` wpisów bez kopiowania całego bufora."""
+    n = len(buf)
+    if limit is None or limit >= n:
+        return list(buf)
+    if limit <= 0:
+        return list(buf)[-limit:]   # zachowanie jak dawne data[-limit:]
+    return list(islice(buf, n - limit, n))
 
 
 def _row_from_entry(entry: Tuple[Direction, AclMessage, str]) -> dict:
@@ -88,34 +138,99 @@ def _row_from_entry(entry: Tuple[Direction, AclMessage, str]) -> dict:
     }
 
 
+def _fit_tail(frags: List[bytes], max_bytes: int | None) -> List[bytes]:
+    """Najnowsze fragmenty mieszczące się w max_bytes (starsze odpadają w całości — JSON zostaje poprawny)."""
+    if max_bytes is None:
+        return frags
+    budget = max_bytes - 2   # nawiasy tablicy
+    k = len(frags)
+    while k > 0:
+        cost = len(frags[k - 1]) + 1   # + przecinek
+        if cost > budget:
+            break
+        budget -= cost
+        k -= 1
+    if k:
+        logger.debug("history: przycięto %d najstarszych wpisów do limitu %d B", k, max_bytes)
+    return frags[k:]
+
+
 def format_for_prompt(
     agent_name: str,
     limit: int | None = None,
     conversation_id: Optional[str] = None,
+    max_bytes: int | None = None,
 ) -> str:
     """
-    Zwraca historię w postaci JSON string (czytelny dla modelu).
+    Zwraca historię w postaci zwartego, kanonicznego JSON string (dla modelu; klucze posortowane).
     - limit: ograniczenie liczby wpisów (od końca)
     - conversation_id: gdy podane, zwraca tylko wątki z danym CID
+    - max_bytes: twardy limit rozmiaru (UTF-8); najstarsze wpisy są pomijane w całości
+    """
+    if conversation_id:
+        entries = recent_thread(agent_name, conversation_id, limit)
+        frags = _fit_tail([_canon(_row_from_entry(e)) for e in entries], max_bytes)
+        return (b"[" + b",".join(frags) + b"]").decode("utf-8")
+
+    buf = _STORE.get(agent_name)
+    if not buf:
+        return "[]"
+    frags = _STORE_JSON[agent_name]
+    n = len(buf)
+    if limit is None or limit >= n:
+        start = 0
+    elif limit <= 0:
+        start = min(n, -limit)   # jak _tail(): data[-limit:]
+    else:
+        start = n - limit
+    # każdy wiersz serializowany raz (kanonicznie: stabilny prefiks promptu); kolejne prompty sklejają gotowe fragmenty
+    for i in range(start, n):
+        if frags[i] is None:
+            frags[i] = _canon(_row_from_entry(buf[i]))
+    kept = _fit_tail(list(islice(frags, start, n)), max_bytes)
+    return (b"[" + b",".join(kept) + b"]").decode("utf-8")
+
+
+def format_for_key(
+    agent_name: str,
+    exclude: Optional[AclMessage] = None,
+    omit: frozenset = frozenset(),
+) -> bytes:
     """
-    entries = (
-        recent_thread(agent_name, conversation_id, limit)
-        if conversation_id
-        else recent(agent_name, limit)
-    )
-    rows = [_row_from_entry(e) for e in entries]
-    import json
-    return json.dumps(rows, ensure_ascii=False, indent=2)
+    Kanoniczny JSON historii do klucza cache odpowiedzi (nie do promptu):
+    - omit: pola wiersza zmienne per wiadomość (np. conversation_id, reply_by) — pomijane,
+    - exclude: wiadomość właśnie zapisana przez odbiorcę (InboxBehaviour) — ostatni wpis
+      z tym samym obiektem ACL jest pomijany, bo klucz i tak zawiera ją osobno.
+    Obejmuje cały bufor (nadzbiór tego, co trafia do promptu po max_bytes).
+    """
+    buf = _STORE.get(agent_name)
+    if not buf:
+        return b"[]"
+    entries = list(buf)
+    if exclude is not None:
+        for i in range(len(entries) - 1, -1, -1):
+            if entries[i][1] is exclude:
+                del entries[i]
+                break
+    rows = []
+    for e in entries:
+        row = _row_from_entry(e)
+        for k in omit:
+            row.pop(k, None)
+        rows.append(row)
+    return _canon(rows)
 
 
 def clear(agent_name: str) -> None:
     """Wyczyść historię jednego agenta."""
     _STORE.pop(agent_name, None)
+    _STORE_JSON.pop(agent_name, None)
+    _THREADS.pop(agent_name, None)
 
 
 def stats() -> dict:
     """Proste statystyki pamięci: ile wpisów per agent i globalny limit."""
     return {
         "agents": {k: len(v) for k, v in _STORE.items()},
-        "default_limit": _default_limit(),
+        "default_limit": _HISTORY_LIMIT,
     }
\ No newline at end of file
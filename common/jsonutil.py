@@ -0,0 +1,49 @@
+# common/jsonutil.py
+# Szybkie JSON dla logów i audytu: orjson, jeśli zainstalowany,
+# w przeciwnym razie stdlib json (ten sam wynik: UTF-8 bez \u-escape).
+
+from __future__ import annotations
+
+import json
+from typing import Any
+
+try:
+    import orjson  # opcjonalne
+except Exception:
+    orjson = None
+
+__all__ = ["dumps", "dumps_bytes", "canonical", "loads"]
+
+
+def dumps(obj: Any, *, indent: bool = False) -> str:
+    """JSON jako str (odpowiednik json.dumps(obj, ensure_ascii=False))."""
+    if orjson is not None:
+        opt = orjson.OPT_NON_STR_KEYS | (orjson.OPT_INDENT_2 if indent else 0)
+        return orjson.dumps(obj, option=opt).decode("utf-8")
+    return json.dumps(obj, ensure_ascii=False, indent=2 if indent else None)
+
+
+def dumps_bytes(obj: Any, *, indent: bool = False, newline: bool = False) -> bytes:
+    """JSON jako bajty UTF-8 — do zapisu wprost w plikach otwartych binarnie."""
+    if orjson is not None:
+        opt = orjson.OPT_NON_STR_KEYS
+        if indent:
+            opt |= orjson.OPT_INDENT_2
+        if newline:
+            opt |= orjson.OPT_APPEND_NEWLINE
+        return orjson.dumps(obj, option=opt)
+    out = json.dumps(obj, ensure_ascii=False, indent=2 if indent else None)
+    return (out + "\n" if newline else out).encode("utf-8")
+
+
+def canonical(obj: Any) -> bytes:
+    """Kanoniczny JSON (klucze posortowane, bez spacji) — ten sam obiekt → te same bajty (klucze cache, stały prefiks promptu)."""
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS)
+    return json.dumps(obj, ensure_ascii=False, sort_keys=True, separators=(",", ":")).encode("utf-8")
+
+
+def loads(data: str | bytes) -> Any:
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
@@ -3,46 +3,83 @@
 from __future__ import annotations
 
 import os
-import json
-from typing import Any, Dict, Tuple
+import atexit
+import random
+import importlib.util
+import hashlib
+import asyncio
+import threading
+from collections import OrderedDict
+from types import MappingProxyType
+from typing import TYPE_CHECKING, Any, Callable, Dict, List, Tuple
 
-import httpx
 import logging
 
-from common.acl import AclMessage, ALLOWED_PERFORMATIVES
+from common.acl import AclMessage, ALLOWED_PERFORMATIVES, ACL_VALIDATOR, ACL_SERIALIZER
+from common.jsonutil import dumps as _dumps, dumps_bytes as _dumps_bytes, canonical as _canon, loads as _loads
 from common.fipa import ensure_reply_by, is_valid_transition
 
+if TYPE_CHECKING:   # tylko adnotacje; w runtime httpx importowany leniwie (patrz _client_kwargs)
+    import httpx
+
 logger = logging.getLogger("common.llm")
 
 # Fallbacki na wypadek braku opcjonalnych modułów:
 try:
-    from common.history import format_for_prompt  # str(agent history JSON)
+    from common.history import format_for_prompt, format_for_key  # str(agent history JSON) / bytes (klucz cache)
 except Exception:
-    def format_for_prompt(agent_name: str, conversation_id: str | None) -> str:
+    def format_for_prompt(agent_name: str, limit: int | None = None, conversation_id: str | None = None,
+                          max_bytes: int | None = None) -> str:
         return "[]"
+    def format_for_key(agent_name: str, exclude: AclMessage | None = None, omit: frozenset = frozenset()) -> bytes:
+        return b"[]"
+
+try:
+    from common.llm_cache import get_exact_cache  # trwały cache odpowiedzi (opcjonalny)
+except Exception:
+    def get_exact_cache():
+        return None
 
 try:
-    from common.audit import save as audit_save, log_ai_request, log_ai_response  # audit_save(agent, conv_id, stage, payload_dict)
+    from common.audit import save as audit_save, save_many as audit_save_many, log_ai_request, log_ai_response  # audit_save(agent, conv_id, stage, payload_dict)
 except Exception:
     def audit_save(agent_name: str, conversation_id: str, stage: str, payload: Dict[str, Any]) -> None:
         pass
+    def audit_save_many(agent_name: str, conversation_id: str, records: list) -> None:
+        pass
 
 
 # --- Ustawienia z .env ---
 OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL", "https://api.openai.com/v1")
+_RESPONSES_URL = f"{OPENAI_BASE_URL.rstrip('/')}/responses"
 OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-4o-mini")
+# Twardy limit historii w prompcie (bajty UTF-8): mniej tokenów → krótsze i tańsze wywołanie
+LLM_MAX_HISTORY_BYTES = int(os.getenv("LLM_MAX_HISTORY_BYTES", "4000"))
 LLM_TEMPERATURE = float(os.getenv("LLM_TEMPERATURE", "0.1"))
 LLM_TOP_P = float(os.getenv("LLM_TOP_P", "1"))
 LLM_MAX_OUTPUT_TOKENS = int(os.getenv("LLM_MAX_OUTPUT_TOKENS", "700"))
 ACL_REPLY_BY_SECONDS = int(os.getenv("ACL_REPLY_BY_SECONDS", "30"))
+OPENAI_MAX_CONCURRENCY = max(1, int(os.getenv("OPENAI_MAX_CONCURRENCY", "8")))
+OPENAI_MAX_RETRIES = max(0, int(os.getenv("OPENAI_MAX_RETRIES", "3")))
+# Zapytanie „zabezpieczające” (hedge): gdy główny model nie odpowie w LLM_HEDGE_MS,
+# równolegle startuje drugie wywołanie (OPENAI_FAST_MODEL); wygrywa pierwsza udana odpowiedź.
+LLM_HEDGE = os.getenv("LLM_HEDGE", "0").strip().lower() in {"1", "true", "yes", "on"}
+LLM_HEDGE_MS = max(0, int(os.getenv("LLM_HEDGE_MS", "300")))
+OPENAI_FAST_MODEL = os.getenv("OPENAI_FAST_MODEL", OPENAI_MODEL)
+
+# Limit równoległych wywołań _call_openai (burst nie zamienia się w lawinę 429)
+_OPENAI_SEM = asyncio.Semaphore(OPENAI_MAX_CONCURRENCY)
+_RETRY_STATUS = frozenset({429, 500, 502, 503, 504})
+
+# --- JSON Schema, które model MUSI zwrócić (stała, zamrożona przy imporcie) ---
+_ENUM_PERFS = sorted(ALLOWED_PERFORMATIVES)
 
-# --- JSON Schema, które model MUSI zwrócić ---
 ACL_JSON_SCHEMA: Dict[str, Any] = {
     "type": "object",
     "additionalProperties": False,
     "required": ["performative", "conversation_id", "ontology", "language", "protocol", "payload"],
     "properties": {
-        "performative": {"type": "string", "enum": sorted(list(ALLOWED_PERFORMATIVES))},
+        "performative": {"type": "string", "enum": _ENUM_PERFS},
         "conversation_id": {"type": "string", "minLength": 1},
         "protocol": {"type": "string"},
         "ontology": {"type": "string"},
@@ -61,9 +98,80 @@ ACL_JSON_SCHEMA: Dict[str, Any] = {
         }
     }
 }
+_ACL_SCHEMA_DICT = ACL_JSON_SCHEMA            # zwykły dict — do serializacji w body
+ACL_JSON_SCHEMA = MappingProxyType(ACL_JSON_SCHEMA)
+
+# Skompilowany walidator schematu (opcjonalnie): szybka ścieżka przed pydantic, nie filtr.
+# Schemat jest węższy niż AclMessage (kanoniczne performatywy, bez dodatkowych kluczy, tags bez null),
+# więc obiekt, który go spełnia, mieści się w kontrakcie modelu; obiekt niezgodny rozstrzyga pydantic.
+# fastjsonschema generuje funkcję Pythona per schemat, jsonschema-rs waliduje w Rust; bez nich — None.
+def _compile_acl_schema():
+    schema = dict(ACL_JSON_SCHEMA)
+    props = dict(schema["properties"])
+    # jak Field(pattern=r"\S") w AclMessage: nie same białe znaki
+    props["conversation_id"] = {**props["conversation_id"], "pattern": r"\S"}
+    schema["properties"] = props
+    try:
+        import fastjsonschema
+        return fastjsonschema.compile(schema)
+    except ImportError:
+        pass
+    try:
+        import jsonschema_rs
+        return jsonschema_rs.validator_for(schema).validate
+    except ImportError:
+        return None
+
+_VALIDATE_ACL = _compile_acl_schema()
+
+# Structured output Responses API: schemat ACL wysyłany w text.format, więc model zwraca sam obiekt JSON
+# (bez instrukcji formatu w prompcie). strict wymaga additionalProperties=false wszędzie, a payload
+# jest otwarty — dlatego domyślnie strict=false (LLM_STRICT_SCHEMA=1 tylko dla zawężonego schematu).
+LLM_STRICT_SCHEMA = os.getenv("LLM_STRICT_SCHEMA", "0").strip().lower() in {"1", "true", "yes", "on"}
+_TEXT_FORMAT: Dict[str, Any] = {"format": {
+    "type": "json_schema",
+    "name": "acl_message",
+    "schema": _ACL_SCHEMA_DICT,
+    "strict": LLM_STRICT_SCHEMA,
+}}
+
+# Body /responses: stałe pola zserializowane raz; per wywołanie dokładamy tylko "input".
+# Szablon: {"model":...,"text":{"format":...},"input":<messages>}
+def _body_prefix(model: str) -> bytes:
+    return _dumps_bytes({"model": model, "text": _TEXT_FORMAT})[:-1] + b',"input":'
+
+_BODY_PREFIX_B = _body_prefix(OPENAI_MODEL)
+_BODY_PREFIXES: Dict[str, bytes] = {OPENAI_MODEL: _BODY_PREFIX_B}
+
+def _responses_body_bytes(messages: list[dict], model: str = OPENAI_MODEL) -> bytes:
+    prefix = _BODY_PREFIXES.get(model)
+    if prefix is None:
+        prefix = _BODY_PREFIXES[model] = _body_prefix(model)
+    return prefix + _dumps_bytes(messages) + b"}"
+
+# Klucz i nagłówki czytane z ENV raz (przy pierwszym użyciu, po ewentualnym load_dotenv),
+# nie przy każdym wywołaniu; reload_config() wymusza ponowny odczyt.
+_OPENAI_KEY: str | None = None
+_OPENAI_HEADERS: Tuple[str, Dict[str, str]] | None = None   # (klucz, nagłówki)
 
 def _get_openai_key() -> str:
-    return (os.getenv("OPENAI_API_KEY") or "").strip()
+    global _OPENAI_KEY
+    if _OPENAI_KEY is None:
+        _OPENAI_KEY = (os.getenv("OPENAI_API_KEY") or "").strip()
+    return _OPENAI_KEY
+
+def _openai_headers(key: str) -> Dict[str, str]:
+    """Nagłówki żądania dla danego klucza (wspólny dict — tylko do odczytu)."""
+    global _OPENAI_HEADERS
+    if _OPENAI_HEADERS is None or _OPENAI_HEADERS[0] != key:
+        _OPENAI_HEADERS = (key, {"Authorization": f"Bearer {key}", "Content-Type": "application/json"})
+    return _OPENAI_HEADERS[1]
+
+def reload_config() -> None:
+    """Ponowny odczyt OPENAI_API_KEY z ENV (np. po zmianie klucza w trakcie działania/testów)."""
+    global _OPENAI_KEY, _OPENAI_HEADERS
+    _OPENAI_KEY = None
+    _OPENAI_HEADERS = None
 
 def _system_prompt(agent_name: str, agent_character: str, registry_excerpt: str) -> str:
     return f"""You are an autonomous XMPP agent speaking FIPA-ACL via JSON.
@@ -87,63 +195,386 @@ Known peers (alias -> character -> jid):
 """
 
 
-def _build_messages(history_json: str, incoming_acl: AclMessage) -> list[dict]:
+_HIST_PREFIX = "HISTORY (last messages for this agent):\n"
+_INCOMING_PREFIX = "INCOMING FIPA-ACL JSON:\n"
+
+def _build_messages(history_json: str, incoming_json: str) -> list[dict]:
+    # JSON bez wcięć: model tokenizuje go tak samo, a serializacja jest kilka razy tańsza
     return [
-        {"role": "user", "content": f"HISTORY (last messages for this agent):\n{history_json}"},
-        {"role": "user", "content": "INCOMING FIPA-ACL JSON:\n" + incoming_acl.model_dump_json(indent=2, ensure_ascii=False)},
-        {"role": "user", "content": "Respond with EXACTLY one JSON object that matches the schema."}
+        {"role": "user", "content": _HIST_PREFIX + history_json},
+        {"role": "user", "content": _INCOMING_PREFIX + incoming_json},
     ]
 
 
-async def _call_openai(agent_name: str, conversation_id: str, system: str, messages: list[dict]) -> Tuple[str, Dict[str, Any]]:
+# Duże odpowiedzi: parsowanie/walidacja w wątku, żeby nie blokować pętli (inne wywołania LLM, odbiór ACL)
+LLM_OFFLOAD_BYTES = int(os.getenv("LLM_OFFLOAD_BYTES", "32000"))
+
+async def _run_sized(size: int, fn, *args):
+    """fn(*args) inline dla małych danych; od LLM_OFFLOAD_BYTES przez asyncio.to_thread."""
+    if size < LLM_OFFLOAD_BYTES:
+        return fn(*args)
+    return await asyncio.to_thread(fn, *args)
+
+
+def _parse_answer(raw_text: str) -> Any:
+    return _answer_object(_loads(raw_text))
+
+
+def _validate_answer(obj: Dict[str, Any]) -> AclMessage:
+    if _VALIDATE_ACL is not None:
+        try:
+            _VALIDATE_ACL(obj)
+        except Exception:
+            pass   # np. "agree", tags: null, dodatkowy klucz — pydantic może to przyjąć/znormalizować
+        else:
+            # zgodny ze schematem → wszystkie pola już w kanonicznej postaci, bez ponownej walidacji
+            return AclMessage.model_construct(**obj)
+    return ACL_VALIDATOR.validate_python(obj)
+
+
+def _extract_json_fast(blob: str) -> Dict[str, Any]:
+    """
+    Pierwszy zbalansowany obiekt {...} z tekstu (np. otoczonego prozą lub ```json```):
+    jeden liniowy przebieg z licznikiem głębokości, z pominięciem nawiasów w stringach.
+    """
+    start = blob.find("{")
+    if start < 0:
+        raise ValueError("no JSON object in model output")
+    depth = 0
+    in_str = esc = False
+    for i in range(start, len(blob)):
+        c = blob[i]
+        if in_str:
+            if esc:
+                esc = False
+            elif c == "\\":
+                esc = True
+            elif c == '"':
+                in_str = False
+        elif c == '"':
+            in_str = True
+        elif c == "{":
+            depth += 1
+        elif c == "}":
+            depth -= 1
+            if depth == 0:
+                return _loads(blob[start:i + 1])
+    raise ValueError("unterminated JSON object in model output")
+
+
+def _output_text(data: Any) -> Any:
+    """
+    Tekst wyjścia Responses API: output[0].content[0].text, inaczej content/response (inni dostawcy).
+    Jedno przejście z testami typów — bez wyjątków na typowej ścieżce. None, gdy nic nie pasuje.
+    """
+    if not isinstance(data, dict):
+        return None
+    output = data.get("output")
+    if isinstance(output, list) and output and isinstance(output[0], dict):
+        content = output[0].get("content")
+        if isinstance(content, list) and content and isinstance(content[0], dict):
+            text = content[0].get("text")
+            if text is not None:
+                return text
+    return data.get("content") or data.get("response")
+
+
+def _answer_object(data: Any) -> Any:
+    """Obiekt odpowiedzi: JSON ACL wprost albo JSON osadzony w tekście wyjścia Responses API."""
+    if isinstance(data, dict) and "performative" not in data and "output" in data:
+        text = _output_text(data)
+        if text is None:
+            return data
+        text = str(text)
+        if text[:1] == "{":
+            # structured output (text.format=json_schema): sam obiekt JSON — parsowanie wprost
+            try:
+                return _loads(text)
+            except ValueError:
+                pass
+        return _extract_json_fast(text)
+    return data
+
+
+def _retry_delay(attempt: int, resp) -> float:
+    """Retry-After (sekundy), jeśli serwer podał; inaczej backoff 2^n (max 8 s) + jitter."""
+    if resp is not None:
+        try:
+            return min(float(resp.headers["Retry-After"]), 30.0)
+        except Exception:
+            pass
+    return min(2 ** attempt, 8) + random.random()
+
+
+async def _post_with_retry(url: str, headers: Dict[str, str], content: bytes, *, timeout: float):
+    """POST przez współdzielony klient; 429/5xx i błędy transportu ponawiane z backoffem."""
+    import httpx
+    client = _get_async_client()
+    for attempt in range(OPENAI_MAX_RETRIES + 1):
+        last = attempt == OPENAI_MAX_RETRIES
+        try:
+            resp = await client.post(url, headers=headers, content=content, timeout=timeout)
+        except httpx.TransportError as e:
+            if last:
+                raise
+            logger.warning("OpenAI: błąd transportu (%s), ponawiam", e)
+            await asyncio.sleep(_retry_delay(attempt, None))
+            continue
+        if resp.status_code not in _RETRY_STATUS or last:
+            return resp
+        logger.warning("OpenAI: HTTP %s, ponawiam", resp.status_code)
+        await asyncio.sleep(_retry_delay(attempt, resp))
+
+
+async def _post_hedged(url: str, headers: Dict[str, str], input_msgs: list[dict]):
+    """
+    Główne wywołanie; drugie (OPENAI_FAST_MODEL) startuje, gdy główne nie skończy się w LLM_HEDGE_MS
+    albo wcześniej zakończy się błędem (HTTP != 200 lub wyjątek transportu) — fallback, nie tylko timeout.
+    Zwraca (resp, model) pierwszej odpowiedzi HTTP 200 (albo ostatniej, gdy żadna nie jest 200);
+    przegrane zadanie jest anulowane (także przy anulowaniu wywołującego). Opóźnienie startu drugiego
+    chroni szczęśliwą ścieżkę przed podwójnym kosztem.
+    """
+    primary = asyncio.ensure_future(
+        _post_with_retry(url, headers, _responses_body_bytes(input_msgs), timeout=30))
+    pending = {primary}
+    try:
+        done, _ = await asyncio.wait(pending, timeout=LLM_HEDGE_MS / 1000)
+        if done and primary.exception() is None and primary.result().status_code == 200:
+            return primary.result(), OPENAI_MODEL
+        fast = asyncio.ensure_future(
+            _post_with_retry(url, headers, _responses_body_bytes(input_msgs, OPENAI_FAST_MODEL), timeout=30))
+        models = {primary: OPENAI_MODEL, fast: OPENAI_FAST_MODEL}
+        pending = {fast} if done else {primary, fast}
+        last = None
+        error: BaseException | None = None
+        if done:
+            if primary.exception() is not None:
+                error = primary.exception()
+            else:
+                last = (primary.result(), OPENAI_MODEL)
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for t in done:
+                if t.exception() is not None:
+                    error = t.exception()
+                    continue
+                last = (t.result(), models[t])
+                if last[0].status_code == 200:
+                    return last
+        if last is not None:
+            return last
+        raise error
+    finally:
+        for t in pending:
+            t.cancel()
+
+
+async def _call_openai(agent_name: str, conversation_id: str, system: str, messages: list[dict]) -> Tuple[str, Dict[str, Any], str]:
     """
     Asynchroniczne wywołanie Responses API.
-    Zwraca (raw_text, raw_json). raw_text = zserializowany JSON odpowiedzi.
+    Zwraca (raw_text, raw_json, model). raw_text = zserializowany JSON odpowiedzi;
+    model = faktycznie użyty (OPENAI_FAST_MODEL, gdy wygrał hedge).
     """
-    url = f"{OPENAI_BASE_URL.rstrip('/')}/responses"
+    url = _RESPONSES_URL
     
     key = _get_openai_key()
     if not key:
         logger.warning("OPENAI_API_KEY brak/pusty – pomijam wywołanie OpenAI.")
         # zwróć „syntetyczną” odpowiedź, by warstwa wyżej mogła stworzyć REFUSE
         data = {"error": "missing_api_key"}
-        raw_text = json.dumps(data, ensure_ascii=False)
-        return raw_text, data
+        raw_text = _dumps(data)
+        return raw_text, data, OPENAI_MODEL
     
-    headers = {
-        "Authorization": f"Bearer {key}",
-        "Content-Type": "application/json",
-    }
+    headers = _openai_headers(key)
+    # prompt systemowy jako pierwszy, stały fragment wejścia (prefix caching po stronie dostawcy)
+    input_msgs = [{"role": "system", "content": system}, *messages]
     body = {
         "model": OPENAI_MODEL,
-        "input": messages,                       # ← zakładam, że messages już jest w formacie Responses API
-        "response_format": {"type": "json_object"},
+        "input": input_msgs,                     # ← format Responses API
+        "text": _TEXT_FORMAT,
     }
 
-    # — log pełnego requestu + etap „prompt” do pliku audytu —
+    # — log pełnego requestu (etap „prompt” zapisuje już ai_respond_to_acl, także przy trafieniu w cache) —
     try:
         log_ai_request(agent_name, conversation_id, "openai", OPENAI_MODEL, body, endpoint=url, headers=headers)
-        audit_save(agent_name, conversation_id, "prompt", {"system": system, "messages": messages, "http_body": body})
     except Exception:
         pass
 
-    async with httpx.AsyncClient(timeout=30) as client:
-        resp = await client.post(url, headers=headers, json=body)
+    # współdzielony klient z pulą połączeń (keep-alive: bez nowego TLS per wywołanie)
+    async with _OPENAI_SEM:
+        if LLM_HEDGE:
+            resp, model_used = await _post_hedged(url, headers, input_msgs)
+        else:
+            resp, model_used = await _post_with_retry(url, headers, _responses_body_bytes(input_msgs), timeout=30), OPENAI_MODEL
 
-    # — odczyt odpowiedzi jako JSON —
+    # — odczyt odpowiedzi jako JSON (bajty wprost do orjson; raw_text to dekodowanie, nie ponowny dump) —
+    body_bytes = resp.content
     try:
-        data: Dict[str, Any] = resp.json()
+        data: Dict[str, Any] = _loads(body_bytes)
+        raw_text = body_bytes.decode("utf-8")
     except Exception:
         data = {"_non_json_body": resp.text}
+        raw_text = _dumps(data)
 
     # — log pełnej odpowiedzi —
     try:
-        log_ai_response(agent_name, conversation_id, "openai", OPENAI_MODEL, int(getattr(resp, "status_code", 0) or 0), data)
+        log_ai_response(agent_name, conversation_id, "openai", model_used, int(getattr(resp, "status_code", 0) or 0), data)
     except Exception:
         pass
 
-    raw_text = json.dumps(data, ensure_ascii=False)
-    return raw_text, data
+    return raw_text, data, model_used
+
+# --- Prompt systemowy per agent: przebudowa tylko po zmianie charakteru lub rejestru ---
+_SYS_PROMPT_CACHE: Dict[str, Tuple[Tuple[str, Any], str]] = {}
+
+def _cached_system_prompt(agent, agent_name: str) -> str:
+    character = getattr(agent, "character", None)
+    if callable(character):          # BaseACLAgent.character() to metoda
+        character = character()
+    agent_character = character or "concise, helpful, task-oriented."
+    # wersja rejestru (BaseACLAgent._REG_VERSION) unieważnia zrzut peerów
+    key = (agent_character, getattr(agent, "_REG_VERSION", None))
+    hit = _SYS_PROMPT_CACHE.get(agent_name)
+    if hit is not None and hit[0] == key:
+        return hit[1]
+
+    registry = []
+    snapshot = getattr(agent, "registry_snapshot", None)
+    if callable(snapshot):
+        # kolejność po aliasie: ten sam rejestr → ten sam tekst promptu (stały prefiks, cache u dostawcy)
+        for alias, meta in sorted(snapshot().items()):
+            registry.append({"alias": alias, "character": meta.get("character", ""), "jid": meta.get("jid", "")})
+    registry_excerpt = _dumps(registry)
+
+    system = _system_prompt(agent_name, agent_character, registry_excerpt)
+    _SYS_PROMPT_CACHE[agent_name] = (key, system)
+    return system
+
+# --- Cache ai_respond_to_acl(): dokładne powtórzenie promptu nie woła modelu ---
+# Klucz: SHA-256 z (model, system, historia, przychodzący ACL) — bez pól per-wiadomość,
+# także w wierszach historii, i bez wpisu bieżącej wiadomości (InboxBehaviour zapisuje ją
+# do historii przed handle_acl); conversation_id/reply_by odpowiedzi i tak nadpisujemy.
+LLM_CACHE_SIZE = int(os.getenv("LLM_CACHE_SIZE", "256"))
+_LLM_CACHE: "OrderedDict[str, Tuple[str, Dict[str, Any]]]" = OrderedDict()
+_LLM_STATS: Dict[str, int] = {"hits": 0, "disk_hits": 0, "misses": 0}
+_ACL_KEY_EXCLUDE = frozenset({"conversation_id", "reply_by", "sender", "receiver"})
+
+def _respond_cache_key(system: str, history_key: bytes, acl_dict: Dict[str, Any]) -> str:
+    acl_part = _canon({k: v for k, v in acl_dict.items() if k not in _ACL_KEY_EXCLUDE})
+    blob = "\x1f".join((OPENAI_MODEL, system)).encode("utf-8") + b"\x1f" + history_key + b"\x1f" + acl_part
+    return hashlib.sha256(blob).hexdigest()
+
+async def _respond_cache_get(key: str) -> Tuple[str, Dict[str, Any]] | None:
+    if LLM_CACHE_SIZE <= 0:
+        return None
+    out = _LLM_CACHE.get(key)
+    if out is None:
+        # drugi poziom: trwały cache SQLite (LLM_CACHE_DB), np. po restarcie procesu
+        # SQLite blokuje (fsync, blokada WAL) — poza pętlą zdarzeń
+        disk = get_exact_cache()
+        out = None
+        if disk is not None:
+            try:
+                out = await asyncio.to_thread(disk.get, key)
+            except Exception as e:
+                logger.warning("LLM cache (SQLite): odczyt nieudany: %s", e)
+        if out is None:
+            _LLM_STATS["misses"] += 1
+            return None
+        _LLM_STATS["disk_hits"] += 1
+        _LLM_CACHE[key] = out
+        while len(_LLM_CACHE) > LLM_CACHE_SIZE:
+            _LLM_CACHE.popitem(last=False)
+        return out
+    _LLM_CACHE.move_to_end(key)
+    _LLM_STATS["hits"] += 1
+    return out
+
+async def _respond_cache_put(key: str, value: Tuple[str, Dict[str, Any]]) -> None:
+    if LLM_CACHE_SIZE <= 0:
+        return
+    _LLM_CACHE[key] = value
+    _LLM_CACHE.move_to_end(key)
+    while len(_LLM_CACHE) > LLM_CACHE_SIZE:
+        _LLM_CACHE.popitem(last=False)
+    disk = get_exact_cache()
+    if disk is not None:
+        try:
+            await asyncio.to_thread(disk.put, key, value)
+        except Exception as e:
+            logger.warning("LLM cache (SQLite): zapis nieudany: %s", e)
+
+# Równoczesne identyczne prompty (ten sam cache_key) czekają na jedno wywołanie modelu
+_RESPOND_INFLIGHT: Dict[str, "asyncio.Future[Tuple[str, Dict[str, Any], str]]"] = {}
+
+async def _call_openai_coalesced(cache_key: str, agent_name: str, conversation_id: str,
+                                 system: str, messages: list[dict]) -> Tuple[str, Dict[str, Any], str]:
+    task = _RESPOND_INFLIGHT.get(cache_key)
+    if task is None:
+        task = asyncio.ensure_future(_call_openai(agent_name, conversation_id, system, messages))
+        _RESPOND_INFLIGHT[cache_key] = task
+        task.add_done_callback(lambda _t: _RESPOND_INFLIGHT.pop(cache_key, None))
+    # shield: anulowanie jednego czekającego nie przerywa wspólnego wywołania
+    return await asyncio.shield(task)
+
+# --- Skróty przed LLM: odpowiedzi deterministyczne bez wywołania modelu ---
+# (a) CANCEL → INFORM (potwierdzenie), (b) REQUEST z pustym payload → REFUSE,
+# (c) ta sama wiadomość co poprzednia w tym CID → poprzednia zwalidowana odpowiedź.
+_LAST_ANSWER: "OrderedDict[Tuple[str, str], Tuple[bytes, AclMessage]]" = OrderedDict()
+
+def _inbound_fingerprint(incoming: AclMessage) -> bytes:
+    return hashlib.blake2b(
+        _canon((incoming.performative, incoming.ontology, incoming.payload)), digest_size=16
+    ).digest()
+
+def _shortcut_cancel(incoming: AclMessage) -> AclMessage | None:
+    return AclMessage.model_construct(
+        performative="INFORM",
+        conversation_id=incoming.conversation_id,
+        protocol=incoming.protocol or "fipa-request",
+        ontology=incoming.ontology,
+        language="json",
+        reply_by=ensure_reply_by(None),
+        payload={"text": "Cancelled."},
+    )
+
+def _shortcut_request(incoming: AclMessage) -> AclMessage | None:
+    if incoming.payload:
+        return None
+    return AclMessage.model_construct(
+        performative="REFUSE",
+        conversation_id=incoming.conversation_id,
+        protocol=incoming.protocol or "fipa-request",
+        ontology=incoming.ontology,
+        language="json",
+        payload={"text": "Empty request payload, nothing to do."},
+    )
+
+# performatyw (kanoniczny) -> reguła skrótu; jedno wyszukanie zamiast łańcucha if-ów
+_SHORTCUTS: Dict[str, Callable[[AclMessage], AclMessage | None]] = {
+    "CANCEL": _shortcut_cancel,
+    "REQUEST": _shortcut_request,
+}
+
+def _shortcut_reply(agent_name: str, incoming: AclMessage) -> AclMessage | None:
+    rule = _SHORTCUTS.get(incoming.performative)
+    if rule is not None:
+        out = rule(incoming)
+        if out is not None:
+            return out
+    hit = _LAST_ANSWER.get((agent_name, incoming.conversation_id))
+    if hit is not None and hit[0] == _inbound_fingerprint(incoming):
+        return hit[1].model_copy(update={"reply_by": ensure_reply_by(None)})
+    return None
+
+def _remember_answer(agent_name: str, incoming: AclMessage, answer: AclMessage) -> None:
+    if LLM_CACHE_SIZE <= 0:
+        return
+    key = (agent_name, incoming.conversation_id)
+    _LAST_ANSWER[key] = (_inbound_fingerprint(incoming), answer)
+    _LAST_ANSWER.move_to_end(key)
+    while len(_LAST_ANSWER) > LLM_CACHE_SIZE:
+        _LAST_ANSWER.popitem(last=False)
 
 async def ai_respond_to_acl(
     agent,
@@ -154,36 +585,39 @@ async def ai_respond_to_acl(
     Zbuduj prompt, zawołaj LLM, zwaliduj i zwróć AclMessage (bez ustawionych sender/receiver).
     """
     agent_name = getattr(agent, "name", "agent")
-    agent_character = getattr(agent, "character", "concise, helpful, task-oriented.")
-    registry = []
-    if hasattr(agent, "get_registry_snapshot"):
-        snap = agent.get_registry_snapshot()
-        for alias, meta in snap.items():
-            registry.append({"alias": alias, "character": meta.get("character", ""), "jid": meta.get("jid", "")})
-    registry_excerpt = json.dumps(registry, ensure_ascii=False, indent=2)
-
-    history_json = format_for_prompt(agent_name, None)
-
-    # Audyt: wejście
-    audit_save(agent_name, incoming.conversation_id, "incoming", {
-        "incoming_acl": json.loads(incoming.model_dump_json())
-    })
-
-    system = _system_prompt(agent_name, agent_character, registry_excerpt)
-    messages = _build_messages(history_json, incoming)
-
-    # Audyt: prompt
-    audit_save(agent_name, incoming.conversation_id, "prompt", {
-        "system": system,
-        "messages": messages,
-    })
 
-    # Call LLM
-    raw_text, raw_json = await _call_openai(agent_name, incoming.conversation_id, system, messages)
+    shortcut = _shortcut_reply(agent_name, incoming)
+    if shortcut is not None:
+        audit_save(agent_name, incoming.conversation_id, "shortcut", ACL_SERIALIZER.to_python(shortcut, mode="json"))
+        return shortcut
+
+    system = _cached_system_prompt(agent, agent_name)
+
+    # jedna serializacja wejścia: dict dla audytu, z niego JSON promptu i klucz cache
+    incoming_dict = ACL_SERIALIZER.to_python(incoming, mode="json")
+    history_json = format_for_prompt(agent_name, None, max_bytes=LLM_MAX_HISTORY_BYTES)
+    messages = _build_messages(history_json, _canon(incoming_dict).decode("utf-8"))
+
+    # Audyt: wejście + prompt jednym zapisem
+    audit_save_many(agent_name, incoming.conversation_id, [
+        ("incoming", {"incoming_acl": incoming_dict}),
+        ("prompt", {"system": system, "messages": messages}),
+    ])
+
+    # Call LLM (dokładne powtórzenie promptu → odpowiedź z cache, bez sieci)
+    cache_key = _respond_cache_key(
+        system, format_for_key(agent_name, exclude=incoming, omit=_ACL_KEY_EXCLUDE), incoming_dict)
+    cached = await _respond_cache_get(cache_key)
+    if cached is not None:
+        raw_text, raw_json = cached
+        model_used = OPENAI_MODEL
+    else:
+        raw_text, raw_json, model_used = await _call_openai_coalesced(
+            cache_key, agent_name, incoming.conversation_id, system, messages)
     
     # brak klucza → _call_openai zwróci {"error":"missing_api_key"}
     if isinstance(raw_json, dict) and raw_json.get("error") == "missing_api_key":
-        return AclMessage(
+        return AclMessage.model_construct(
             performative="REFUSE",
             conversation_id=incoming.conversation_id,
             protocol=incoming.protocol or "fipa-request",
@@ -195,14 +629,15 @@ async def ai_respond_to_acl(
     # Audyt: surowa odpowiedź
     audit_save(agent_name, incoming.conversation_id, "raw_response", {
         "raw_text": raw_text,
-        "raw_json": raw_json
+        "raw_json": raw_json,
+        "cache_hit": cached is not None,
     })
 
     # Parsowanie JSON
     try:
-        obj = json.loads(raw_text)
+        obj = await _run_sized(len(raw_text), _parse_answer, raw_text)
     except Exception as e:
-        refuse = AclMessage(
+        refuse = AclMessage.model_construct(
             performative="REFUSE",
             conversation_id=incoming.conversation_id,
             protocol=incoming.protocol or "fipa-request",
@@ -213,7 +648,8 @@ async def ai_respond_to_acl(
         audit_save(agent_name, incoming.conversation_id, "error", {"reason": "non_json", "detail": str(e)})
         return refuse
 
-    # Walidacja + dopięcie reply_by
+    # Walidacja + dopięcie reply_by (model_validate tylko dla obiektu od modelu;
+    # REFUSE budujemy z pól już zwalidowanych → model_construct bez ponownej walidacji)
     try:
         if not obj.get("reply_by"):
             obj["reply_by"] = ensure_reply_by(None)  # +30s
@@ -224,10 +660,10 @@ async def ai_respond_to_acl(
         obj["sender"] = None
         obj["receiver"] = None
 
-        answer = AclMessage.model_validate(obj)
+        answer = await _run_sized(len(raw_text), _validate_answer, obj)
 
         if not is_valid_transition(incoming.performative, answer.performative):
-            answer = AclMessage(
+            answer = AclMessage.model_construct(
                 performative="REFUSE",
                 conversation_id=incoming.conversation_id,
                 protocol=incoming.protocol or "fipa-request",
@@ -235,12 +671,18 @@ async def ai_respond_to_acl(
                 language="json",
                 payload={"text": f"Invalid transition {incoming.performative} -> {obj.get('performative')}, refusing."}
             )
-
-        audit_save(agent_name, incoming.conversation_id, "validated", json.loads(answer.model_dump_json()))
+        else:
+            # do cache tylko odpowiedzi, które przeszły walidację i przejście FIPA — i tylko od
+            # modelu z klucza (OPENAI_MODEL); wygrana hedge'a (OPENAI_FAST_MODEL) nie udaje głównego
+            if model_used == OPENAI_MODEL:
+                await _respond_cache_put(cache_key, (raw_text, raw_json))
+            _remember_answer(agent_name, incoming, answer)
+
+        audit_save(agent_name, incoming.conversation_id, "validated", ACL_SERIALIZER.to_python(answer, mode="json"))
         return answer
 
     except Exception as e:
-        refuse = AclMessage(
+        refuse = AclMessage.model_construct(
             performative="REFUSE",
             conversation_id=incoming.conversation_id,
             protocol=incoming.protocol or "fipa-request",
@@ -251,21 +693,97 @@ async def ai_respond_to_acl(
         audit_save(agent_name, incoming.conversation_id, "error", {"reason": "validation", "detail": str(e)})
         return refuse
     
-# --- Shim kompatybilności dla starszego kodu (np. agents/explorer_ai.py) ---
-def suggest(text: str, system: str = "You are concise.") -> str:
-    """
-    Prosty prompt pomocniczy. Zwraca tekst.
-    Loguje pełne body żądania i pełną odpowiedź.
-    """
-    key = _get_openai_key()
-    if not key:
-        return text  # bezpieczny fallback
-
-    url = f"{OPENAI_BASE_URL.rstrip('/')}/responses"
-    headers = {
-        "Authorization": f"Bearer {key}",
-        "Content-Type": "application/json",
+# --- Cache suggest(): dokładne powtórzenia (text, system) nie wołają modelu ---
+SUGGEST_CACHE_SIZE = int(os.getenv("LLM_SUGGEST_CACHE_SIZE", "512"))
+_SUGGEST_CACHE: "OrderedDict[Tuple[str, str], str]" = OrderedDict()
+_SUGGEST_LOCK = threading.Lock()   # suggest() bywa wołane z wątków (asyncio.to_thread)
+_SUGGEST_STATS: Dict[str, int] = {"hits": 0, "misses": 0}
+
+def get_cache_stats() -> Dict[str, int]:
+    """Statystyki cache suggest(): trafienia, chybienia, rozmiar."""
+    with _SUGGEST_LOCK:
+        return {**_SUGGEST_STATS, "size": len(_SUGGEST_CACHE), "maxsize": SUGGEST_CACHE_SIZE}
+
+def get_respond_cache_stats() -> Dict[str, int]:
+    """Statystyki cache ai_respond_to_acl(): trafienia, chybienia, rozmiar."""
+    return {**_LLM_STATS, "size": len(_LLM_CACHE), "maxsize": LLM_CACHE_SIZE}
+
+def _suggest_cache_get(key: Tuple[str, str]) -> str | None:
+    with _SUGGEST_LOCK:
+        out = _SUGGEST_CACHE.get(key)
+        if out is None:
+            _SUGGEST_STATS["misses"] += 1
+            return None
+        _SUGGEST_CACHE.move_to_end(key)
+        _SUGGEST_STATS["hits"] += 1
+        return out
+
+def _suggest_cache_put(key: Tuple[str, str], out: str) -> None:
+    if SUGGEST_CACHE_SIZE <= 0:
+        return
+    with _SUGGEST_LOCK:
+        _SUGGEST_CACHE[key] = out
+        _SUGGEST_CACHE.move_to_end(key)
+        while len(_SUGGEST_CACHE) > SUGGEST_CACHE_SIZE:
+            _SUGGEST_CACHE.popitem(last=False)
+
+
+# --- Wspólne klienty HTTP (pula połączeń, keep-alive) dla _call_openai()/asuggest()/suggest() ---
+# httpx importowany leniwie — ścieżka bez OPENAI_API_KEY nie płaci za import.
+# HTTP/2 (multipleksowanie na jednym połączeniu) tylko, gdy zainstalowany pakiet h2.
+_HTTP2 = importlib.util.find_spec("h2") is not None
+
+def _client_kwargs() -> Dict[str, Any]:
+    import httpx
+    return {
+        "timeout": 15,
+        "http2": _HTTP2,
+        "limits": httpx.Limits(max_connections=32, max_keepalive_connections=16, keepalive_expiry=30),
     }
+
+_ASYNC_CLIENT: httpx.AsyncClient | None = None
+
+def _get_async_client() -> httpx.AsyncClient:
+    global _ASYNC_CLIENT
+    if _ASYNC_CLIENT is None or _ASYNC_CLIENT.is_closed:
+        import httpx
+        _ASYNC_CLIENT = httpx.AsyncClient(**_client_kwargs())
+    return _ASYNC_CLIENT
+
+# Synchroniczny odpowiednik dla suggest() (wołane też z wątków — tworzenie pod blokadą)
+_SYNC_CLIENT: httpx.Client | None = None
+_SYNC_CLIENT_LOCK = threading.Lock()
+
+def _get_sync_client() -> httpx.Client:
+    global _SYNC_CLIENT
+    with _SYNC_CLIENT_LOCK:
+        if _SYNC_CLIENT is None or _SYNC_CLIENT.is_closed:
+            import httpx
+            _SYNC_CLIENT = httpx.Client(**_client_kwargs())
+        return _SYNC_CLIENT
+
+async def aclose_clients() -> None:
+    """Zamknij współdzielone klienty HTTP (wołać przy wyłączaniu, w działającej pętli)."""
+    global _ASYNC_CLIENT
+    client, _ASYNC_CLIENT = _ASYNC_CLIENT, None
+    if client is not None and not client.is_closed:
+        await client.aclose()
+    _close_sync_client()
+
+def _close_sync_client() -> None:
+    global _SYNC_CLIENT
+    with _SYNC_CLIENT_LOCK:
+        client, _SYNC_CLIENT = _SYNC_CLIENT, None
+    if client is not None:
+        client.close()
+
+# klient async wymaga pętli do aclose(), więc przy wyjściu domykamy tylko synchroniczny
+atexit.register(_close_sync_client)
+
+
+def _suggest_request(key: str, text: str, system: str) -> Tuple[str, Dict[str, str], Dict[str, Any]]:
+    url = _RESPONSES_URL
+    headers = _openai_headers(key)
     body = {
         "model": OPENAI_MODEL,
         "input": [
@@ -281,12 +799,13 @@ def suggest(text: str, system: str = "You are concise.") -> str:
         log_ai_request(None, None, "openai", OPENAI_MODEL, body, endpoint=url, headers=headers)
     except Exception:
         pass
+    return url, headers, body
 
-    r = httpx.post(url, headers=headers, json=body, timeout=15)
 
+def _suggest_result(cache_key: Tuple[str, str], r: httpx.Response) -> str:
     # — zczytanie i zalogowanie odpowiedzi —
     try:
-        data = r.json()
+        data = _loads(r.content)
     except Exception:
         data = {"_non_json_body": r.text}
 
@@ -296,12 +815,71 @@ def suggest(text: str, system: str = "You are concise.") -> str:
         pass
 
     # — ekstrakcja tekstu (dostosowana do Responses API) —
-    out = None
-    # próba wg nowego schematu:
-    try:
-        out = data["output"][0]["content"][0]["text"]
-    except Exception:
-        # inne ścieżki, zależnie od providera/formatu
-        out = data.get("content") or data.get("response") or str(data)
+    out = _output_text(data)
+    out = str(out) if out is not None else str(data)
+    if r.status_code == 200:
+        _suggest_cache_put(cache_key, out)
+    return out
+
 
-    return str(out) if out is not None else ""
+# --- Shim kompatybilności dla starszego kodu (np. agents/explorer_ai.py) ---
+def suggest(text: str, system: str = "You are concise.") -> str:
+    """
+    Prosty prompt pomocniczy. Zwraca tekst.
+    Loguje pełne body żądania i pełną odpowiedź.
+    Udane odpowiedzi są zapamiętywane (LRU, LLM_SUGGEST_CACHE_SIZE).
+    Blokuje wątek — z kodu async używaj asuggest().
+    """
+    key = _get_openai_key()
+    if not key:
+        return text  # bezpieczny fallback
+
+    cache_key = (text, system)
+    cached = _suggest_cache_get(cache_key)
+    if cached is not None:
+        return cached
+
+    url, headers, body = _suggest_request(key, text, system)
+    r = _get_sync_client().post(url, headers=headers, content=_dumps_bytes(body))
+    return _suggest_result(cache_key, r)
+
+
+# Zapytania asuggest() w locie: ten sam (text, system) czeka na jedno wywołanie HTTP
+_SUGGEST_INFLIGHT: Dict[Tuple[str, str], "asyncio.Future[str]"] = {}
+
+async def asuggest(text: str, system: str = "You are concise.") -> str:
+    """
+    Jak suggest(), ale nieblokująco, przez współdzielony httpx.AsyncClient.
+    Równoczesne identyczne zapytania są sklejane w jedno wywołanie modelu.
+    """
+    key = _get_openai_key()
+    if not key:
+        return text  # bezpieczny fallback
+
+    cache_key = (text, system)
+    cached = _suggest_cache_get(cache_key)
+    if cached is not None:
+        return cached
+
+    task = _SUGGEST_INFLIGHT.get(cache_key)
+    if task is None:
+        task = asyncio.ensure_future(_asuggest_fetch(key, cache_key, text, system))
+        _SUGGEST_INFLIGHT[cache_key] = task
+        task.add_done_callback(lambda _t: _SUGGEST_INFLIGHT.pop(cache_key, None))
+    # shield: anulowanie jednego czekającego nie przerywa wspólnego wywołania
+    return await asyncio.shield(task)
+
+
+async def _asuggest_fetch(key: str, cache_key: Tuple[str, str], text: str, system: str) -> str:
+    url, headers, body = _suggest_request(key, text, system)
+    async with _OPENAI_SEM:   # wspólny limit równoległych wywołań z _call_openai()
+        r = await _get_async_client().post(url, headers=headers, content=_dumps_bytes(body))
+    return _suggest_result(cache_key, r)
+
+
+async def suggest_many(texts: List[str], system: str = "You are concise.") -> List[str]:
+    """
+    Wiele asuggest() naraz (asyncio.gather) — wywołania sieciowe nakładają się w czasie,
+    liczba równoległych żądań ograniczona przez OPENAI_MAX_CONCURRENCY. Kolejność jak w texts.
+    """
+    return list(await asyncio.gather(*(asuggest(t, system) for t in texts)))
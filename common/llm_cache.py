@@ -0,0 +1,104 @@
+# common/llm_cache.py
+# Trwały cache odpowiedzi LLM (dokładne dopasowanie klucza) w SQLite — przeżywa restart procesu.
+# Włączany przez LLM_CACHE_DB=<ścieżka>; bez zmiennej moduł nic nie zapisuje.
+from __future__ import annotations
+
+import os
+import sqlite3
+import logging
+import threading
+from pathlib import Path
+from typing import Any, Dict, Optional, Tuple
+
+from common.jsonutil import dumps as _dumps, loads as _loads
+
+logger = logging.getLogger("common.llm_cache")
+
+__all__ = ["ExactCache", "get_exact_cache"]
+
+
+class ExactCache:
+    """
+    Klucz (hex SHA-256 promptu) -> (raw_text, raw_json).
+    Jedno połączenie na proces pod blokadą; zapytania po kluczu głównym są pod-milisekundowe.
+    Metody są blokujące — z pętli asyncio wołać przez asyncio.to_thread().
+    Wymiana LRU: trafienie odświeża ts, przycinanie usuwa najdawniej używane wpisy,
+    ale tylko co trim_every zapisów (między przycięciami tabela może chwilowo przekroczyć max_rows).
+    """
+
+    def __init__(self, path: str | os.PathLike, max_rows: int = 10_000, trim_every: int = 64):
+        p = Path(path)
+        p.parent.mkdir(parents=True, exist_ok=True)
+        self._max_rows = max(1, int(max_rows))
+        self._trim_every = max(1, int(trim_every))
+        self._puts = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(str(p), check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS llm_cache ("
+            " key TEXT PRIMARY KEY, raw_text TEXT NOT NULL, raw_json TEXT NOT NULL,"
+            " ts REAL DEFAULT (julianday('now')))"
+        )
+        # przycinanie sortuje po ts — bez indeksu byłby to pełny skan tabeli
+        self._db.execute("CREATE INDEX IF NOT EXISTS llm_cache_ts ON llm_cache (ts)")
+
+    def get(self, key: str) -> Optional[Tuple[str, Dict[str, Any]]]:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT raw_text, raw_json FROM llm_cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row is not None:
+                self._db.execute(
+                    "UPDATE llm_cache SET ts = julianday('now') WHERE key = ?", (key,)
+                )
+        if row is None:
+            return None
+        try:
+            return row[0], _loads(row[1])
+        except Exception:
+            return None
+
+    def put(self, key: str, value: Tuple[str, Dict[str, Any]]) -> None:
+        raw_text, raw_json = value
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO llm_cache (key, raw_text, raw_json) VALUES (?, ?, ?)",
+                (key, raw_text, _dumps(raw_json)),
+            )
+            self._puts += 1
+            if self._puts % self._trim_every:
+                return
+            # przycięcie do max_rows: usuń najdawniej używane wpisy
+            self._db.execute(
+                "DELETE FROM llm_cache WHERE key IN ("
+                " SELECT key FROM llm_cache ORDER BY ts DESC LIMIT -1 OFFSET ?)",
+                (self._max_rows,),
+            )
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()
+
+
+_EXACT: Optional[ExactCache] = None
+_EXACT_INIT = False
+_EXACT_LOCK = threading.Lock()
+
+def get_exact_cache() -> Optional[ExactCache]:
+    """Cache z LLM_CACHE_DB (tworzony raz); None, gdy wyłączony lub baza niedostępna."""
+    global _EXACT, _EXACT_INIT
+    if _EXACT_INIT:
+        return _EXACT
+    with _EXACT_LOCK:
+        if not _EXACT_INIT:
+            path = os.getenv("LLM_CACHE_DB", "").strip()
+            if path:
+                try:
+                    _EXACT = ExactCache(path, int(os.getenv("LLM_CACHE_DB_ROWS", "10000")),
+                                        int(os.getenv("LLM_CACHE_DB_TRIM_EVERY", "64")))
+                except Exception as e:
+                    logger.warning("LLM cache (SQLite) niedostępny: %s", e)
+            _EXACT_INIT = True
+    return _EXACT
@@ -0,0 +1,99 @@
+# tests/test_llm_hedge.py
+# _post_hedged(): drugi model startuje po timeoucie ORAZ po szybkiej porażce głównego;
+# anulowanie wywołującego anuluje też wywołanie główne.
+import asyncio
+import os
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+
+_TMP = tempfile.mkdtemp(prefix="office-tests-")
+os.environ.setdefault("AUDIT_DIR", str(Path(_TMP, "ai_audit")))
+os.environ.setdefault("AGENTS_REG_PATH", str(Path(_TMP, "agents_registry.json")))
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+import common.llm as llm
+
+
+class _Resp:
+    def __init__(self, status_code: int):
+        self.status_code = status_code
+
+
+class PostHedgedTest(unittest.TestCase):
+    def setUp(self):
+        self._orig = (llm._post_with_retry, llm._responses_body_bytes,
+                      llm.OPENAI_MODEL, llm.OPENAI_FAST_MODEL, llm.LLM_HEDGE_MS)
+        llm.OPENAI_MODEL, llm.OPENAI_FAST_MODEL, llm.LLM_HEDGE_MS = "main", "fast", 200
+        llm._responses_body_bytes = lambda msgs, model=None: (model or llm.OPENAI_MODEL).encode()
+        self.calls = []
+        self.cancelled = []
+
+    def tearDown(self):
+        (llm._post_with_retry, llm._responses_body_bytes,
+         llm.OPENAI_MODEL, llm.OPENAI_FAST_MODEL, llm.LLM_HEDGE_MS) = self._orig
+
+    def _stub(self, behaviour):
+        """behaviour: model -> (opóźnienie s, status albo wyjątek)."""
+        async def post(url, headers, content, *, timeout):
+            model = content.decode()
+            self.calls.append(model)
+            delay, result = behaviour[model]
+            try:
+                await asyncio.sleep(delay)
+            except asyncio.CancelledError:
+                self.cancelled.append(model)
+                raise
+            if isinstance(result, BaseException):
+                raise result
+            return _Resp(result)
+        llm._post_with_retry = post
+
+    def _run(self):
+        return asyncio.run(llm._post_hedged("u", {}, []))
+
+    def test_fast_primary_success_skips_hedge(self):
+        self._stub({"main": (0, 200)})
+        resp, model = self._run()
+        self.assertEqual((resp.status_code, model, self.calls), (200, "main", ["main"]))
+
+    def test_fast_primary_error_status_falls_back(self):
+        self._stub({"main": (0, 500), "fast": (0, 200)})
+        resp, model = self._run()
+        self.assertEqual((resp.status_code, model), (200, "fast"))
+
+    def test_primary_exception_falls_back(self):
+        self._stub({"main": (0, ConnectionError("down")), "fast": (0, 200)})
+        resp, model = self._run()
+        self.assertEqual((resp.status_code, model), (200, "fast"))
+
+    def test_both_fail_returns_last_response(self):
+        self._stub({"main": (0, 500), "fast": (0, ConnectionError("down"))})
+        resp, model = self._run()
+        self.assertEqual((resp.status_code, model), (500, "main"))
+
+    def test_slow_primary_loses_to_fast(self):
+        self._stub({"main": (5, 200), "fast": (0, 200)})
+        resp, model = self._run()
+        self.assertEqual(model, "fast")
+        self.assertEqual(self.cancelled, ["main"])
+
+    def test_caller_cancel_cancels_primary(self):
+        self._stub({"main": (5, 200)})
+
+        async def scenario():
+            task = asyncio.ensure_future(llm._post_hedged("u", {}, []))
+            await asyncio.sleep(0.05)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+            await asyncio.sleep(0)
+            # jeszcze w pętli: asyncio.run() anulowałby osierocone zadanie dopiero przy zamknięciu
+            self.assertEqual(self.cancelled, ["main"])
+
+        asyncio.run(scenario())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,132 @@
+# tests/test_llm_respond_cache.py
+# Cache odpowiedzi ai_respond_to_acl() w kolejności z produkcji:
+# InboxBehaviour zapisuje IN do historii, dopiero potem autopilot woła LLM.
+import asyncio
+import os
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+
+_TMP = tempfile.mkdtemp(prefix="office-tests-")
+os.environ.setdefault("AUDIT_DIR", str(Path(_TMP, "ai_audit")))
+os.environ.setdefault("AGENTS_REG_PATH", str(Path(_TMP, "agents_registry.json")))
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+os.environ["AGENT_AUTO_AI"] = "1"
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from spade.message import Message
+
+import common.llm as llm
+from common import history
+from common.acl import AclMessage
+from common.base import BaseACLAgent, InboxBehaviour
+
+_ANSWER = '{"performative": "AGREE", "conversation_id": "x", "payload": {"text": "ok"}}'
+
+
+class RespondCacheOrderTest(unittest.TestCase):
+    def setUp(self):
+        self.calls = 0
+        self.model_used = llm.OPENAI_MODEL
+
+        async def fake_call_openai(agent_name, conversation_id, system, messages):
+            self.calls += 1
+            return _ANSWER, {"stub": True}, self.model_used
+
+        self._orig_call = llm._call_openai
+        llm._call_openai = fake_call_openai
+        self._orig_get_exact = llm.get_exact_cache
+        llm.get_exact_cache = lambda: None   # tylko poziom w pamięci
+        llm._LLM_CACHE.clear()
+        llm._LAST_ANSWER.clear()
+        for k in llm._LLM_STATS:
+            llm._LLM_STATS[k] = 0
+
+    def tearDown(self):
+        llm._call_openai = self._orig_call
+        llm.get_exact_cache = self._orig_get_exact
+        llm._LLM_CACHE.clear()
+        llm._LAST_ANSWER.clear()
+
+    @staticmethod
+    def _spade_request(cid: str, reply_by: str) -> Message:
+        acl = AclMessage(
+            performative="REQUEST", conversation_id=cid, reply_by=reply_by,
+            payload={"text": "2 bułki"},
+        )
+        return acl.to_spade("auto@h", "human@h")
+
+    async def _deliver(self, agent: BaseACLAgent, msg: Message) -> list:
+        """Jedna iteracja InboxBehaviour (record IN → handle_acl → autopilot) z przechwyconą wysyłką."""
+        sent = []
+
+        async def capture(to_jid, acl, *, raw=None):
+            sent.append((to_jid, acl))
+
+        async def receive(timeout=None):
+            return msg
+
+        inbox = InboxBehaviour()
+        inbox.set_agent(agent)
+        inbox.receive = receive
+        agent.send_acl = capture
+        await inbox.run()
+        return sent
+
+    def test_repeat_after_history_reset_hits_cache(self):
+        async def scenario():
+            agent = BaseACLAgent("auto@h", "p")
+            agent._bind_role_handler()
+            name = agent.name
+            history.clear(name)
+
+            first = await self._deliver(agent, self._spade_request("cid-1", "2026-01-01T00:00:00Z"))
+            # bieżąca wiadomość jest już w historii, gdy autopilot liczy klucz
+            self.assertEqual(history.recent(name)[0][1].conversation_id, "cid-1")
+
+            # ten sam stan wejścia (pusta historia, ta sama treść), inne pola per wiadomość
+            history.clear(name)
+            second = await self._deliver(agent, self._spade_request("cid-2", "2026-02-02T00:00:00Z"))
+            return first, second
+
+        first, second = asyncio.run(scenario())
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(llm._LLM_STATS["hits"], 1)
+        self.assertEqual(llm._LLM_STATS["misses"], 1)
+        self.assertEqual(second[0][1].performative, "AGREE")
+        self.assertEqual(second[0][1].conversation_id, "cid-2")
+
+    def test_hedge_win_from_fast_model_is_not_cached(self):
+        self.model_used = "fast-model"
+
+        async def scenario():
+            agent = BaseACLAgent("auto@h", "p")
+            agent._bind_role_handler()
+            history.clear(agent.name)
+            sent = await self._deliver(agent, self._spade_request("cid-1", "2026-01-01T00:00:00Z"))
+            history.clear(agent.name)
+            return sent
+
+        sent = asyncio.run(scenario())
+        self.assertEqual(sent[0][1].performative, "AGREE")
+        self.assertEqual(len(llm._LLM_CACHE), 0)
+
+    def test_history_key_skips_incoming_and_per_message_fields(self):
+        name = "key-agent"
+        history.clear(name)
+        a = AclMessage(performative="REQUEST", conversation_id="c1", reply_by="2026-01-01T00:00:00Z")
+        b = AclMessage(performative="REQUEST", conversation_id="c2", reply_by="2026-03-03T00:00:00Z")
+        history.record(name, "IN", a, "human@h")
+        key_a = history.format_for_key(name, exclude=a, omit=llm._ACL_KEY_EXCLUDE)
+        history.record(name, "IN", b, "human@h")
+        key_ab = history.format_for_key(name, exclude=b, omit=llm._ACL_KEY_EXCLUDE)
+        self.assertEqual(key_a, b"[]")
+        self.assertNotIn(b"c1", key_ab)
+        self.assertNotIn(b"2026", key_ab)
+        self.assertIn(b'"REQUEST"', key_ab)
+        history.clear(name)
+
+
+if __name__ == "__main__":
+    unittest.main()
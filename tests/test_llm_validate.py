@@ -0,0 +1,58 @@
+# tests/test_llm_validate.py
+# _validate_answer(): schemat (fastjsonschema/jsonschema-rs, jeśli są) nie może odrzucić
+# odpowiedzi, którą przyjmuje AclMessage — to tylko szybka ścieżka przed pydantic.
+import os
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+
+_TMP = tempfile.mkdtemp(prefix="office-tests-")
+os.environ.setdefault("AUDIT_DIR", str(Path(_TMP, "ai_audit")))
+os.environ.setdefault("AGENTS_REG_PATH", str(Path(_TMP, "agents_registry.json")))
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+import common.llm as llm
+
+
+def _answer(**over):
+    obj = {
+        "performative": "AGREE",
+        "conversation_id": "c-1",
+        "protocol": "fipa-request",
+        "ontology": "office.demo",
+        "language": "json",
+        "reply_by": None,
+        "sender": None,
+        "receiver": None,
+        "payload": {"text": "ok", "tags": ["a"]},
+    }
+    obj.update(over)
+    return obj
+
+
+class ValidateAnswerTest(unittest.TestCase):
+    def test_schema_valid_answer(self):
+        acl = llm._validate_answer(_answer())
+        self.assertEqual((acl.performative, acl.conversation_id), ("AGREE", "c-1"))
+
+    def test_lowercase_performative_is_normalized(self):
+        self.assertEqual(llm._validate_answer(_answer(performative="agree")).performative, "AGREE")
+
+    def test_null_tags_accepted(self):
+        acl = llm._validate_answer(_answer(payload={"text": "ok", "tags": None}))
+        self.assertIsNone(acl.payload["tags"])
+
+    def test_extra_top_level_key_accepted(self):
+        acl = llm._validate_answer(_answer(note="extra"))
+        self.assertEqual(acl.performative, "AGREE")
+
+    def test_invalid_answer_still_rejected(self):
+        with self.assertRaises(Exception):
+            llm._validate_answer(_answer(performative="SHRUG"))
+        with self.assertRaises(Exception):
+            llm._validate_answer(_answer(conversation_id="   "))
+
+
+if __name__ == "__main__":
+    unittest.main()